@@ -1 +1,3 @@
-__all__ = ["licenseheaders"]
+from .licenseheaders import HeaderProcessor
+
+__all__ = ["licenseheaders", "HeaderProcessor"]
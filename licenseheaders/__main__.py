@@ -0,0 +1,7 @@
+"""Run licenseheaders as python -m licenseheaders."""
+
+import sys
+
+from .licenseheaders import main
+
+sys.exit(main())
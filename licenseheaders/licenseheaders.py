@@ -28,18 +28,19 @@
 from __future__ import unicode_literals
 from __future__ import print_function
 
+## only what every run needs is imported here, the rest where it is used, to keep the startup quick
 import os
-import shutil
 import sys
 import logging
 import argparse
 import re
-import fnmatch
 from string import Template
-from shutil import copyfile
 import io
-import subprocess
-import datetime
+import codecs
+import mmap
+import collections
+import functools
+import time
 
 __author__ = 'Johann Petrak, David Smerkous, Mayk Choji'
 __license__ = 'MIT'
@@ -48,182 +49,221 @@ __version__ = '0.4'
 
 log = logging.getLogger(__name__)
 
+try:
+    timer = time.perf_counter
+except AttributeError:
+    timer = time.time
+
 
 try:
     unicode
 except NameError:
     unicode = str
 
-# for each processing type, the detailed settings of how to process files of that type
-typeSettings = {
-    "java": {
-        "extensions": [".java",".scala",".groovy",".jape"],
-        "keepFirst": None,
-        "blockCommentStartPattern": re.compile('^\s*/\*'),  ## used to find the beginning of a header bloc
-        "blockCommentEndPattern": re.compile(r'\*/\s*$'),   ## used to find the end of a header block
-        "lineCommentStartPattern": re.compile(r'\s*//'),    ## used to find header blocks made by line comments
-        "lineCommentEndPattern": None,
-        "headerStartLine": "/*\n",   ## inserted before the first header text line
-        "headerEndLine": " */\n",    ## inserted after the last header text line
-        "headerLinePrefix": " * ",   ## inserted before each header text line
-        "headerLineSuffix": None,            ## inserted after each header text line, but before the new line
-    },
-    "javascript": {
-        "extensions": [".js",".ts",".jsx",".jsx"],
-        "keepFirst": None,
-        "blockCommentStartPattern": re.compile('^\s*/\*'),  ## used to find the beginning of a header bloc
-        "blockCommentEndPattern": re.compile(r'\*/\s*$'),   ## used to find the end of a header block
-        "lineCommentStartPattern": re.compile(r'\s*//'),    ## used to find header blocks made by line comments
-        "lineCommentEndPattern": None,
-        "headerStartLine": "/*\n",   ## inserted before the first header text line
-        "headerEndLine": " */\n",    ## inserted after the last header text line
-        "headerLinePrefix": " * ",   ## inserted before each header text line
-        "headerLineSuffix": None,            ## inserted after each header text line, but before the new line
-    },
-    "script": {
-        "extensions": [".sh",".csh",".py",".pl"],
-        "keepFirst": re.compile(r'^#!'),
-        "blockCommentStartPattern": None,
-        "blockCommentEndPattern": None,
-        "lineCommentStartPattern": re.compile(r'\s*#'),    ## used to find header blocks made by line comments
-        "lineCommentEndPattern": None,
-        "headerStartLine": "##\n",   ## inserted before the first header text line
-        "headerEndLine": "##\n",    ## inserted after the last header text line
-        "headerLinePrefix": "## ",   ## inserted before each header text line
-        "headerLineSuffix": None            ## inserted after each header text line, but before the new line
-    },
-    "xml": {
-        "extensions": [".xml"],
-        "keepFirst": re.compile(r'^\s*<\?xml.*\?>'),
-        "blockCommentStartPattern": re.compile(r'^\s*<!--'),
-        "blockCommentEndPattern": re.compile(r'-->\s*$'),
-        "lineCommentStartPattern": None,    ## used to find header blocks made by line comments
-        "lineCommentEndPattern": None,
-        "headerStartLine": "<!--\n",   ## inserted before the first header text line
-        "headerEndLine": "  -->\n",    ## inserted after the last header text line
-        "headerLinePrefix": "-- ",   ## inserted before each header text line
-        "headerLineSuffix": None            ## inserted after each header text line, but before the new line
-    },
-    "sql": {
-        "extensions": [".sql"],
-        "keepFirst": None,
-        "blockCommentStartPattern": None, #re.compile('^\s*/\*'),
-        "blockCommentEndPattern": None, #re.compile(r'\*/\s*$'),
-        "lineCommentStartPattern": re.compile(r'\s*--'),    ## used to find header blocks made by line comments
-        "lineCommentEndPattern": None,
-        "headerStartLine": "--\n",   ## inserted before the first header text line
-        "headerEndLine": "--\n",    ## inserted after the last header text line
-        "headerLinePrefix": "-- ",   ## inserted before each header text line
-        "headerLineSuffix": None            ## inserted after each header text line, but before the new line
-    },
-    "c": {
-        "extensions": [".c",".cc",".cpp",".c++",".h",".hpp"],
-        "keepFirst": None,
-        "blockCommentStartPattern": re.compile(r'^\s*/\*'),
-        "blockCommentEndPattern": re.compile(r'\*/\s*$'),
-        "lineCommentStartPattern": re.compile(r'\s*//'),    ## used to find header blocks made by line comments
-        "lineCommentEndPattern": None,
-        "headerStartLine": "/*\n",   ## inserted before the first header text line
-        "headerEndLine": " */\n",    ## inserted after the last header text line
-        "headerLinePrefix": " * ",   ## inserted before each header text line
-        "headerLineSuffix": None            ## inserted after each header text line, but before the new line
-    },
-    "ruby": {
-        "extensions": [".rb"],
-        "keepFirst": "^#!",
-        "blockCommentStartPattern": re.compile('^=begin'),
-        "blockCommentEndPattern": re.compile(r'^=end'),
-        "lineCommentStartPattern": re.compile(r'\s*#'),    ## used to find header blocks made by line comments
-        "lineCommentEndPattern": None,
-        "headerStartLine": "##\n",   ## inserted before the first header text line
-        "headerEndLine": "##\n",    ## inserted after the last header text line
-        "headerLinePrefix": "## ",   ## inserted before each header text line
-        "headerLineSuffix": None            ## inserted after each header text line, but before the new line
-    },
-    "csharp": {
-        "extensions": [".cs"],
-        "keepFirst": None,
-        "blockCommentStartPattern": None,
-        "blockCommentEndPattern": None,
-        "lineCommentStartPattern": re.compile(r'\s*//'),    ## used to find header blocks made by line comments
-        "lineCommentEndPattern": None,
-        "headerStartLine": None,   ## inserted before the first header text line
-        "headerEndLine": None,    ## inserted after the last header text line
-        "headerLinePrefix": "// ",   ## inserted before each header text line
-        "headerLineSuffix": None            ## inserted after each header text line, but before the new line
-    },
-    "vb": {
-        "extensions": [".vb"],
-        "keepFirst": None,
-        "blockCommentStartPattern": None,
-        "blockCommentEndPattern": None,
-        "lineCommentStartPattern": re.compile(r"^\s*\'"),    ## used to find header blocks made by line comments
-        "lineCommentEndPattern": None,
-        "headerStartLine": None,   ## inserted before the first header text line
-        "headerEndLine": None,    ## inserted after the last header text line
-        "headerLinePrefix": "' ",   ## inserted before each header text line
-        "headerLineSuffix": None            ## inserted after each header text line, but before the new line
-    },
-    "erlang": {
-        "extensions": [".erl", ".src", ".config", ".schema"],
-        "keepFirst": None,
-        "blockCommentStartPattern": None,  ## used to find the beginning of a header bloc
-        "blockCommentEndPattern": None,   ## used to find the end of a header block
-        "lineCommentStartPattern": None,    ## used to find header blocks made by line comments
-        "lineCommentEndPattern": None,
-        "headerStartLine": "%% -*- erlang -*-\n%% %CopyrightBegin%\n%%\n",   ## inserted before the first header text line
-        "headerEndLine": "%%\n%% %CopyrightEnd%\n\n",    ## inserted after the last header text line
-        "headerLinePrefix": "%% ",   ## inserted before each header text line
-        "headerLineSuffix": None,            ## inserted after each header text line, but before the new line
-    },
-    "python": {
-        "extensions": [".py"],
-        "keepFirst": re.compile(r'^#!'),
-        "keepMore": re.compile(r'^#.*coding.+'),  ## keep special lines after the first line
-        "blockCommentStartPattern": None,  ## used to find the beginning of a header bloc
-        "blockCommentEndPattern": None,   ## used to find the end of a header block
-        "lineCommentStartPattern": re.compile(r'^\s*#'),    ## used to find header blocks made by line comments
-        "lineCommentEndPattern": None,
-        "headerStartLine": "#\n",   ## inserted before the first header text line
-        "headerEndLine": "#\n",    ## inserted after the last header text line
-        "headerLinePrefix": "# ",   ## inserted before each header text line
-        "headerLineSuffix": None,            ## inserted after each header text line, but before the new line
-    }
-}
-
-yearsPattern = re.compile(r"Copyright\s*(?:\(\s*[C|c|©]\s*\)\s*)?([0-9][0-9][0-9][0-9](?:-[0-9][0-9]?[0-9]?[0-9]?))",re.IGNORECASE)
+## the directories of version control systems, which are never descended into: they hold the history and
+## hooks of the repository, not its sources
+VCS_DIRS = frozenset([".git", ".hg", ".svn"])
+
+## the file with the settings of each language, i.e. how to process files of that type, see LanguageRegistry
+LANGUAGES_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "languages.json")
+## at most this many bytes of the first line of an extensionless file are read to look for a shebang
+SHEBANG_MAX = 256
+
+class Language(object):
+    """The settings of a language from the languages file, i.e. how to process files of that type.
+
+    The attributes are the keys of the languages file:
+    name: the name of the processing type
+    extensions, filenames: the suffixes (which may be compound like .d.ts) and base names of its files
+    interpreters: the commands of a shebang line which identify an extensionless file of this type
+    priority: the language with the highest priority gets a suffix or interpreter listed by several languages
+    keepFirst, keepMore: patterns of the first line, and of the following lines, to keep above the header
+    blockCommentStartPattern, blockCommentEndPattern, lineCommentStartPattern: patterns used to find the
+      header, lineCommentEndPattern is not used
+    headerStartLine, headerEndLine, headerLinePrefix, headerLineSuffix: inserted before and after the header,
+      and before and after each line of the template, or None
+    The same four are kept utf8 encoded in headerStart, headerEnd, linePrefix and lineSuffix (b"" for None),
+    and the compiled Detector is built on first use.
+    """
+
+    KEYS = ("name", "extensions", "filenames", "interpreters", "priority", "keepFirst", "keepMore",
+            "blockCommentStartPattern", "blockCommentEndPattern", "lineCommentStartPattern", "lineCommentEndPattern",
+            "headerStartLine", "headerEndLine", "headerLinePrefix", "headerLineSuffix")
+    __slots__ = KEYS + ("headerStart", "headerEnd", "linePrefix", "lineSuffix", "_detector")
+
+    def __init__(self, settings):
+        for key in self.KEYS:
+            setattr(self, key, settings.get(key))
+        self.extensions = tuple(self.extensions or ())
+        self.filenames = tuple(self.filenames or ())
+        self.interpreters = tuple(self.interpreters or ())
+        self.priority = self.priority or 0
+        self.headerStart = (self.headerStartLine or "").encode('utf8')
+        self.headerEnd = (self.headerEndLine or "").encode('utf8')
+        self.linePrefix = (self.headerLinePrefix or "").encode('utf8')
+        self.lineSuffix = (self.headerLineSuffix or "").encode('utf8')
+        self._detector = None
+
+    @property
+    def detector(self):
+        if self._detector is None:
+            self._detector = Detector(self)
+        return self._detector
+
+    def __repr__(self):
+        return "Language({!r})".format(self.name)
+
+class LanguageRegistry(object):
+    """The languages of the languages file, with the tables to find the language of a file.
+
+    The language of a file is resolved from its base name with a single dictionary probe, keyed by the
+    last extension of the name (or the whole name if it has none), which gives the few candidates with
+    that ending: the file names first, then the suffixes from the longest, so that a.d.ts gets the language
+    of .d.ts before the one of .ts. Files without an extension can also be recognised by the interpreter
+    of their shebang line, see sniff. The registry is built once and not changed afterwards.
+    """
+
+    __slots__ = ("languages", "byName", "byEnding", "byInterpreter")
+
+    def __init__(self, languages):
+        self.languages = tuple(languages)
+        self.byName = dict((language.name, language) for language in self.languages)
+        ## the language of each file name and suffix, the one with the highest (or first) priority if listed twice
+        owners = {}
+        interpreters = {}
+        for language in self.languages:
+            for pattern in [(name, True) for name in language.filenames] + [(ext, False) for ext in language.extensions]:
+                if pattern not in owners or language.priority > owners[pattern].priority:
+                    owners[pattern] = language
+            for interpreter in language.interpreters:
+                if interpreter not in interpreters or language.priority > interpreters[interpreter].priority:
+                    interpreters[interpreter] = language
+        candidates = collections.defaultdict(list)
+        for (pattern, exact), language in owners.items():
+            candidates[self._ending(pattern)].append((pattern, exact, language))
+        self.byEnding = dict((ending, tuple(sorted(c, key=lambda c: (not c[1], -len(c[0]), c[0]))))
+                             for ending, c in candidates.items())
+        self.byInterpreter = interpreters
+
+    @staticmethod
+    def _ending(name):
+        dot = name.rfind(".")
+        return name[dot:] if dot > 0 else name
+
+    def get(self, name):
+        """Return the language with the given name."""
+        return self.byName[name]
+
+    def lookup(self, name):
+        """Return the language of a file with the base name name from its name or suffix, or None."""
+        dot = name.rfind(".")
+        candidates = self.byEnding.get(name[dot:] if dot > 0 else name)
+        if candidates:
+            for pattern, exact, language in candidates:
+                if name == pattern if exact else len(name) > len(pattern) and name.endswith(pattern):
+                    return language
+        return None
+
+    def candidate(self, name):
+        """Tell if a file with the base name name may be supported: it has a known name or suffix, or it
+        has no extension and could be a script with a shebang line."""
+        return self.lookup(name) is not None or name.rfind(".") <= 0
+
+    def sniff(self, line):
+        """Return the language of the interpreter of a shebang line, given as bytes, or None.
+
+        With #!/usr/bin/env the interpreter is the first argument which is not an option or a variable,
+        and a version at the end of the interpreter is ignored if it is not listed, e.g. python3.11.
+        """
+        if not line.startswith(b"#!"):
+            return None
+        words = line[2:].split()
+        if words and os.path.basename(words[0]) == b"env":
+            words = [w for w in words[1:] if not w.startswith(b"-") and b"=" not in w]
+        if not words:
+            return None
+        interpreter = os.path.basename(words[0]).decode('utf8', 'replace')
+        language = self.byInterpreter.get(interpreter)
+        if language is None:
+            language = self.byInterpreter.get(interpreter.rstrip("0123456789."))
+        return language
+
+    def for_file(self, name, f):
+        """Return the language of a file with the base name name, or None, looking at the shebang line
+        in the binary file object f if the name does not tell. f is left at the start of the file."""
+        language = self.lookup(name)
+        if language is None and name.rfind(".") <= 0:
+            language = self.sniff(f.readline(SHEBANG_MAX))
+            f.seek(0)
+        return language
+
+## the LanguageRegistry, loaded by get_languages
+_languages = None
+
+def get_languages():
+    """Return the LanguageRegistry, loading the languages file on first use."""
+    global _languages
+    if _languages is None:
+        import json
+        with io.open(LANGUAGES_FILE, 'r', encoding='utf8') as f:
+            _languages = LanguageRegistry(Language(settings) for settings in json.load(f))
+    return _languages
+
+yearsPattern = re.compile(r"Copyright\s*(?:\(\s*[C|c|©]\s*\)\s*)?([0-9][0-9][0-9][0-9](?:-[0-9][0-9]?[0-9]?[0-9]?)?)",re.IGNORECASE)
 licensePattern = re.compile(r"license",re.IGNORECASE)
 emptyPattern = re.compile(r'^\s*$')
 
 ## -----------------------
 
-## maps each extension to its processing type. Filled from tpeSettings during initialization
-ext2type = {}
-patterns = []
+## number of files handed to a worker at once, and number of batches in flight per worker when using --jobs
+JOB_BATCH_SIZE = 64
+JOB_WINDOW = 4
+## default number of files in flight with --async
+ASYNC_CONCURRENCY = 64
+## seconds between two looks at the tree when --watch has to poll
+WATCH_INTERVAL = 0.5
+## at most this many bytes of the list of files given with --files-from are read at once
+FILE_LIST_CHUNK = 64 * 1024
 
-def parse_command_line(argv):
-    """Parse command line argument. See -h option.
+## size of the chunks in which the rest of a file is copied when a header is written
+COPY_BUFSIZE = 1024 * 1024
+## files of at least this size are copied through a memory map instead, and patched in place when the new
+## content has the same length as the content it replaces
+MMAP_THRESHOLD = 1024 * 1024
+## when only the years are updated, the header is only looked for in this many bytes at the start of a file
+YEARS_WINDOW = 32 * 1024
+## maximum number of rendered headers which include the file name kept in memory, see renderedHeaders
+HEADER_CACHE_SIZE = 4096
 
-    Arguments:
-      argv: arguments on the command line must include caller file name.
+## default name of the cache file used with --cache, and maximum number of files it remembers
+CACHE_FILE_NAME = ".licenseheaders-cache"
+CACHE_MAX_ENTRIES = 1000000
 
-    """
+## number of slowest files shown with --stats
+STATS_SLOWEST = 10
+
+## the names and files of the built-in templates, listed when they are first needed
+_templates = None
+
+def builtin_templates():
+    """Return the sorted list of the (name, file) of the built-in templates."""
+    global _templates
+    if _templates is None:
+        templatesDir = os.path.join(os.path.dirname(os.path.abspath(__file__)),"templates")
+        _templates = sorted((os.path.splitext(name)[0], os.path.join(templatesDir, name))
+                            for name in os.listdir(templatesDir) if name.endswith(".tmpl"))
+    return _templates
+
+def help_epilog(prog):
+    """Return the text shown after the options by --help: the templates, extensions and an example."""
     import textwrap
 
-    ## first get all the names of our own templates
-    ## for this get first the path of this file
-    templatesDir = os.path.join(os.path.dirname(os.path.abspath(__file__)),"templates")
-    ## get all the templates in the templates directory
-    templates = [f for f in get_paths("*.tmpl",templatesDir)]
-    templates = [os.path.splitext(os.path.basename(t))[0] for t in templates]
-    templates_str = ", ".join(sorted(templates))
-    ## get all supported extensions
+    templates_str = ", ".join(t[0] for t in builtin_templates())
+    ## get all supported extensions and file names
     patterns = set()
-    for t in typeSettings:
-        settings = typeSettings[t]
-        exts = settings["extensions"]
-        for ext in exts:
-            patterns.add("*"+ext)
+    for language in get_languages().languages:
+        patterns.update("*"+ext for ext in language.extensions)
+        patterns.update(language.filenames)
     patterns_str = ", ".join(sorted(patterns))
 
     example = textwrap.dedent("""
@@ -235,18 +275,38 @@ def parse_command_line(argv):
         # Use "Eager Hacker" as the copyright owner.
         {}
         {} -t lgpl-v3 -c "Eager Hacker"
-        """).format('='*50, '='*50, os.path.basename(argv[0]))
-
-    formatter_class = argparse.RawDescriptionHelpFormatter
+        """).format('='*50, '='*50, prog)
 
     extra_templ = textwrap.fill("Supported template names (TMPL): " + templates_str, 75)
     extra_pat = textwrap.fill(("If EXCLUDE is not specified, license header will "
                                 + "be added to all files with following extensions: "
-                                + patterns_str), 75)
-    extra_info = extra_templ + "\n\n" + extra_pat + "\n\n" + example
-    parser = argparse.ArgumentParser(description="Python license header updater",
-                                     epilog=extra_info,
-                                     formatter_class=formatter_class)
+                                + patterns_str + ", and to files without an extension which start "
+                                + "with a shebang line of a known interpreter"), 75)
+    return extra_templ + "\n\n" + extra_pat + "\n\n" + example
+
+class HelpParser(argparse.ArgumentParser):
+    """An argument parser which only puts together the help text when it is shown."""
+
+    def format_help(self):
+        self.epilog = help_epilog(self.prog)
+        return argparse.ArgumentParser.format_help(self)
+
+## the name of the program for the usage and help, from argv[0]: python -m licenseheaders runs __main__.py
+def program_name(argv):
+    if os.path.basename(argv[0]) == "__main__.py":
+        return "licenseheaders"
+    return os.path.basename(argv[0])
+
+def parse_command_line(argv):
+    """Parse command line argument. See -h option.
+
+    Arguments:
+      argv: arguments on the command line must include caller file name.
+
+    """
+    formatter_class = argparse.RawDescriptionHelpFormatter
+    parser = HelpParser(prog=program_name(argv), description="Python license header updater",
+                        formatter_class=formatter_class)
     parser.add_argument("-V", "--version", action="version",
                         version="%(prog)s {}".format(__version__))
     parser.add_argument("-v", "--verbose", dest="verbose_count",
@@ -259,6 +319,9 @@ def parse_command_line(argv):
                         help="Template name or file to use.")
     parser.add_argument("-y", "--years", dest="years", nargs=1, type=str, default=None,
                         help="Year or year range to use.")
+    parser.add_argument("--merge-years", dest="merge_years", action="store_true", default=False,
+                        help="When only updating the years (-y without -t), extend the existing years to a range "
+                        "ending with the last of the given years, e.g. 2016 becomes 2016-2026 with -y 2026")
     parser.add_argument("-o", "--owner", dest="owner", nargs=1, type=str, default=None,
                         help="Name of copyright owner to use.")
     parser.add_argument("-n", "--projname", dest="projectname", nargs=1, type=str, default=None,
@@ -267,8 +330,75 @@ def parse_command_line(argv):
                         help="Url of project to use.")
     parser.add_argument("-f", "--include-file", dest="includefile", type=bool, default=True,
                         help="Include the file name in the header or not")
+    parser.add_argument("--config", dest="config", type=str, default=None, metavar="FILE",
+                        help="A JSON file with rules which give the files below some paths their own template "
+                        "and settings (years, owner, projectname, projecturl), which replace the ones given on the "
+                        "command line, e.g. {\"rules\": [{\"path\": \"plugins/\", \"template\": \"gpl-v3\"}]}. "
+                        "The paths are globs relative to the directory of FILE, and the deepest one wins")
     parser.add_argument("-e", "--exclude", action="append", type=str, default=None,
-                        help="Exclude files that have this pattern")
+                        help="Exclude files whose path, starting with the directory to process, contains this "
+                        "pattern")
+    parser.add_argument("--exclude-glob", dest="exclude_glob", action="append", type=str, default=None,
+                        metavar="GLOB",
+                        help="Exclude files matching this .gitignore style glob, relative to the directory to "
+                        "process, e.g. build/, /docs/*.py or **/generated/")
+    parser.add_argument("--since", dest="since", type=str, default=None, metavar="REF",
+                        help="Only process the files which git reports as changed compared to REF, "
+                        "including new untracked files, instead of all the files in the directory")
+    parser.add_argument("--staged", dest="staged", action="store_true", default=False,
+                        help="Only process the files which are staged in the git index, e.g. for a pre-commit hook")
+    parser.add_argument("--files-from", dest="files_from", type=str, default=None, metavar="FILE",
+                        help="Only process the files listed in FILE, one per line, or standard input with -. The "
+                        "files are processed as the list is read, e.g. at the end of a pipe")
+    parser.add_argument("-0", "--null", dest="null", action="store_true", default=False,
+                        help="The files of --files-from are separated by NUL characters instead of newlines, "
+                        "e.g. for git ls-files -z or find -print0")
+    parser.add_argument("--shard", dest="shard", type=parse_shard, default=None, metavar="K/N",
+                        help="Only process the K-th of N disjoint slices of the files, e.g. on the K-th of N CI "
+                        "runners. A file goes to a slice by a hash of its path, or as balanced by --shard-weights")
+    parser.add_argument("--shard-weights", dest="shard_weights", type=str, default=None, metavar="REPORT",
+                        help="Spread the files over the slices of --shard so that each takes about the same time, "
+                        "using the time of each file in the --report of a previous run")
+    parser.add_argument("--report", dest="report", type=str, default=None, metavar="FILE",
+                        help="Save the counts, statistics, exit status and the time taken by each file as JSON to "
+                        "FILE. The reports of the shards of a run are combined with: %(prog)s merge-reports REPORT...")
+    parser.add_argument("--gitignore", dest="gitignore", action="store_true", default=False,
+                        help="Also exclude the files ignored by the .gitignore files in the directory")
+    parser.add_argument("-j", "--jobs", dest="jobs", type=int, default=1,
+                        help="Number of files to process in parallel (default: 1)")
+    parser.add_argument("--threads", dest="threads", action="store_true", default=False,
+                        help="Use a pool of threads instead of processes for --jobs")
+    parser.add_argument("--async", dest="concurrency", type=int, nargs="?", const=ASYNC_CONCURRENCY, default=0,
+                        metavar="N",
+                        help="Overlap the file I/O of up to N files at a time (default: {}) with asyncio, for file "
+                        "systems with a high latency like NFS or SMB mounts".format(ASYNC_CONCURRENCY))
+    parser.add_argument("--watch", dest="watch", nargs="?", const="auto", choices=["auto", "poll"], default=None,
+                        help="After processing the files, keep running and process each new file created or "
+                        "renamed in the directory, until interrupted. The file system events are used where "
+                        "available (inotify), with poll the directory is scanned every {} seconds instead, "
+                        "e.g. for network file systems".format(WATCH_INTERVAL))
+    parser.add_argument("--check", dest="check", action="store_true", default=False,
+                        help="Do not change any file, only check their headers and print one JSON line per file "
+                        "with its status: missing, outdated (only the years differ), mismatch or ok. "
+                        "The exit status is 1 if any file is not ok")
+    parser.add_argument("-b", "--backup", dest="backup", action="store_true", default=False,
+                        help="Keep the original of each changed file with the additional extension .bak")
+    parser.add_argument("--fsync", dest="fsync", choices=["none", "file", "dir", "end"], default="none",
+                        help="When to flush changed files to disk: not at all (none, the default), each file and its "
+                        "directory as it is written (file), each file as it is written and each directory once at "
+                        "the end (dir), or all files and directories at the end (end)")
+    parser.add_argument("--stats", dest="stats", nargs="?", choices=["table", "json"], default=None, const="table",
+                        help="Print the time spent in each stage, counters and the slowest files to standard error, "
+                        "as a table (the default) or as JSON")
+    parser.add_argument("--profile", dest="profile", type=str, default=None, metavar="FILE",
+                        help="Profile the run with cProfile and save the result to FILE. With --jobs only the "
+                        "main process is profiled, use --jobs 1 to include the processing of the files")
+    parser.add_argument("--cache", dest="cache", nargs="?", type=str, default=None, const=CACHE_FILE_NAME,
+                        help="Remember the files which are up to date in this cache file and do not read them "
+                        "again on the next run. A relative name is taken relative to the directory to process "
+                        "(default: {})".format(CACHE_FILE_NAME))
+    parser.add_argument("--cache-size", dest="cache_size", type=int, default=CACHE_MAX_ENTRIES,
+                        help="Maximum number of files to remember in the cache (default: {})".format(CACHE_MAX_ENTRIES))
     arguments = parser.parse_args(argv[1:])
 
     # Sets log level to WARN going more verbose for each new -V.
@@ -276,157 +406,1740 @@ def parse_command_line(argv):
     return arguments
 
 
-def get_paths(patterns, start_dir="."):
-    """Retrieve files that match any of the glob patterns from the start_dir and below."""
-    for root, dirs, files in os.walk(start_dir):
-        names = []
-        for pattern in patterns:
-            names += fnmatch.filter(files, pattern)
-        for name in names:
-            path = os.path.join(root, name)
+## translate a gitignore style glob to a regular expression, matching only within one path component
+## for * and ?, and across components for **
+def glob_to_regex(pattern):
+    res = []
+    i = 0
+    n = len(pattern)
+    while i < n:
+        c = pattern[i]
+        if pattern.startswith("**/", i):
+            res.append("(?:.*/)?")
+            i = i+3
+            continue
+        if pattern.startswith("**", i):
+            res.append(".*")
+            i = i+2
+            continue
+        if c == "*":
+            res.append("[^/]*")
+        elif c == "?":
+            res.append("[^/]")
+        elif c == "[" and "]" in pattern[i+2:]:
+            j = pattern.index("]", i+2)
+            cls = pattern[i+1:j]
+            if cls.startswith("!"):
+                cls = "^" + cls[1:]
+            res.append("[" + cls.replace("\\", "\\\\") + "]")
+            i = j
+        else:
+            res.append(re.escape(c))
+        i = i+1
+    return "".join(res)
+
+## compile exclude patterns into a single regular expression which is matched against paths relative
+## to the directory to process, using / as separator and with a trailing / for directories.
+## The patterns follow the .gitignore rules: a pattern containing a / is anchored at base (the relative
+## path of the directory of the .gitignore file, with a trailing /), otherwise it can match at any level,
+## a trailing / only matches directories and ** matches across directories.
+## The substrings (of the -e option) exclude every path which contains them once prefix (the directory to
+## process, with a trailing separator) is put in front of it, like the -e option always did.
+## With isGitignore, comments and empty lines are skipped.
+## Negated patterns (starting with !) are not supported and are ignored.
+## Returns None if there is nothing to exclude.
+def compile_excludes(patterns, base="", isGitignore=False, substrings=(), prefix=""):
+    regexes = [_substring_regex(substring, prefix) for substring in substrings if substring]
+    for pattern in patterns:
+        if isGitignore:
+            pattern = pattern.rstrip("\r\n").rstrip(" ")
+            if not pattern or pattern.startswith("#"):
+                continue
+        if pattern.startswith("!"):
+            logging.debug("Negated exclude patterns are not supported, ignoring %s",pattern)
+            continue
+        if pattern.startswith("./"):
+            pattern = pattern[2:]
+        dirOnly = pattern.endswith("/")
+        pattern = pattern.rstrip("/")
+        if not pattern:
+            continue
+        if "/" in pattern:
+            regex = re.escape(base) + glob_to_regex(pattern.lstrip("/"))
+        else:
+            regex = re.escape(base) + "(?:.*/)?" + glob_to_regex(pattern)
+        if dirOnly:
+            regexes.append(regex + "/.*")
+        else:
+            regexes.append(regex + "(?:/.*)?")
+    if not regexes:
+        return None
+    return re.compile("(?:" + "|".join(regexes) + ")\\Z", re.DOTALL)
+
+## return the source of a regular expression which matches a relative path if prefix + path contains
+## substring, also where the substring starts in the prefix and ends in the path
+def _substring_regex(substring, prefix):
+    if substring in prefix:
+        return ".*"
+    alternatives = [".*" + re.escape(substring) + ".*"]
+    for k in range(1, len(substring)):
+        if prefix.endswith(substring[:k]):
+            alternatives.append(re.escape(substring[k:]) + ".*")
+    return "(?:" + "|".join(alternatives) + ")"
+
+def is_excluded(relPath, excludes):
+    """Check a relative path against a list of compiled exclude patterns."""
+    for exclude in excludes:
+        if exclude.match(relPath):
+            return True
+    return False
+
+def find_files(start_dir, exclude=None, gitignore=False):
+    """Retrieve the files of a supported type from the start_dir and below, in a deterministic order.
+
+    Directories which match the compiled exclude pattern are not descended into. With gitignore, the
+    .gitignore files found on the way are honoured as well. The directories of VCS_DIRS are always skipped.
+    """
+    return walk_files(start_dir, "", [exclude] if exclude else [], gitignore)
+
+def walk_files(start_dir, relDir, excludes, gitignore=False, onDir=None):
+    """Retrieve the files like find_files, from a directory which has the path relDir (ending with a slash,
+    or empty) relative to the top of the tree, and the given exclude patterns for its contents.
+
+    If given, onDir is called with the path, the relative path and the exclude patterns of each directory
+    visited (including the patterns of its .gitignore), which is what a walk from there needs.
+    """
+    languages = get_languages()
+    ## a stack of the directories still to visit, with their path relative to the top and the exclude
+    ## patterns which apply to them
+    stack = [(start_dir, relDir, excludes)]
+    while stack:
+        dirPath, relDir, excludes = stack.pop()
+        try:
+            entries = sorted(os.scandir(dirPath), key=lambda e: e.name)
+        except OSError as e:
+            logging.warning("Cannot read directory %s: %s",dirPath,e)
+            continue
+        if gitignore and any(e.name == ".gitignore" for e in entries):
+            with io.open(os.path.join(dirPath, ".gitignore"),'r', encoding='utf8', errors='replace') as f:
+                ignored = compile_excludes(f.readlines(), relDir, isGitignore=True)
+            if ignored:
+                excludes = excludes + [ignored]
+        if onDir:
+            onDir(dirPath, relDir, excludes)
+        subdirs = []
+        for entry in entries:
+            relPath = relDir + entry.name
+            if entry.is_dir():
+                if entry.is_symlink() or entry.name in VCS_DIRS:
+                    continue
+                if not is_excluded(relPath + "/", excludes):
+                    subdirs.append((os.path.join(dirPath, entry.name), relPath + "/", excludes))
+            elif languages.candidate(entry.name) and not is_excluded(relPath, excludes):
+                yield os.path.join(dirPath, entry.name)
+        stack.extend(reversed(subdirs))
+
+def git_files(start_dir, since=None, staged=False, exclude=None):
+    """Retrieve the files of a supported type in or below start_dir which changed according to git.
+
+    With staged, these are the files added, copied, modified or renamed in the index, otherwise in the
+    working tree, compared to the ref since (or to the index if since is None). Files in the working
+    tree which are not tracked and not ignored are included as well. Only the changed files are looked
+    at, so this takes time proportional to the size of the change and not of the tree.
+    Raises ValueError if since is not a commit, so that it can never be taken as an option of git, and
+    subprocess.CalledProcessError (or OSError if git is missing) if git fails.
+    """
+    import subprocess
+    cmd = ["git", "-C", start_dir, "diff", "--name-only", "-z", "--relative", "--diff-filter=ACMR"]
+    if staged:
+        cmd.append("--cached")
+    if since:
+        if since.startswith("-"):
+            raise ValueError("Not a commit: " + since)
+        try:
+            commit = subprocess.check_output(["git", "-C", start_dir, "rev-parse", "--verify", "--quiet",
+                                              since + "^{commit}"])
+        except subprocess.CalledProcessError as e:
+            ## with --quiet, git only fails with 1 if since is not a commit, e.g. not if this is no repository
+            if e.returncode != 1:
+                raise
+            raise ValueError("Not a commit: " + since)
+        cmd.extend([os.fsdecode(commit.strip()), "--"])
+    output = subprocess.check_output(cmd)
+    if not staged:
+        output += subprocess.check_output(["git", "-C", start_dir, "ls-files", "-z", "--others", "--exclude-standard"])
+    relPaths = set(os.fsdecode(p) for p in output.split(b"\0") if p)
+    languages = get_languages()
+    for relPath in sorted(relPaths):
+        if not languages.candidate(os.path.basename(relPath)):
+            continue
+        if exclude and exclude.match(relPath):
+            continue
+        yield os.path.join(start_dir, relPath)
+
+def read_file_list(stream, separator=b"\n", exclude=None):
+    """Retrieve the files of a supported type from a binary stream listing their paths, separated by
+    separator (a newline or NUL), as the paths arrive.
+
+    The stream is read in chunks of whatever is available, so that the first files can be processed while
+    the program writing the list is still running, and only the paths of the current chunk are held in
+    memory. Empty entries are skipped, and with newlines a carriage return before the newline is dropped.
+    The compiled exclude pattern is matched against the paths without a leading ./.
+    """
+    read = getattr(stream, "read1", stream.read)
+    languages = get_languages()
+    rest = b""
+    while True:
+        chunk = read(FILE_LIST_CHUNK)
+        entries = (rest + chunk).split(separator)
+        ## the last entry is incomplete unless the stream ended
+        rest = entries.pop() if chunk else b""
+        for entry in entries:
+            if separator == b"\n" and entry.endswith(b"\r"):
+                entry = entry[:-1]
+            if not entry:
+                continue
+            path = os.fsdecode(entry)
+            if not languages.candidate(os.path.basename(path)):
+                continue
+            if exclude and exclude.match(path[2:] if path.startswith("./") else path):
+                continue
             yield path
+        if not chunk:
+            break
 
-# return an array of lines, with all the variables replaced
-# throws an error if a variable cannot be replaced
-def read_template(templateFile, fileName, dict):
-    with io.open(templateFile,'r') as f:
-        lines = f.readlines()
-    try:
-        dict["file_name"] = fileName if dict["includefile"] else "This file"
-    except:
-        dict["file_name"] = "This file" # don't ask for permission ask for forgiveness
-    lines = [Template(line).substitute(dict) for line in lines]  ## use safe_substitute if we do not want an error
-    return lines
+class LRUCache(object):
+    """A dictionary of at most maxEntries entries, which evicts the least recently used one when full.
 
-# format the template lines for the given type
-def for_type(templatelines,type):
-    lines = []
-    settings = typeSettings[type]
-    headerStartLine = settings["headerStartLine"]
-    headerEndLine = settings["headerEndLine"]
-    headerLinePrefix = settings["headerLinePrefix"]
-    headerLineSuffix = settings["headerLineSuffix"]
-    if headerStartLine is not None:
-        lines.append(headerStartLine)
-    for l in templatelines:
-        tmp = l
-        if headerLinePrefix is not None:
-            tmp = headerLinePrefix + tmp
-        if headerLineSuffix is not None:
-            tmp = tmp + headerLineSuffix
-        lines.append(tmp)
-    if headerEndLine is not None:
-        lines.append(headerEndLine)
-    return lines
-
-
-## read a file and return a dictionary with the following elements:
-## lines: array of lines
+    It can be shared by threads, for --threads and --async.
+    """
+
+    def __init__(self, maxEntries):
+        import threading
+        self.maxEntries = maxEntries
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """Return the value of key, or None if it is not in the cache."""
+        with self.lock:
+            value = self.entries.get(key)
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            if len(self.entries) > self.maxEntries:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+## the rendered headers which include the file name, of all the CompiledTemplates, by fingerprint of the
+## template, type, file name and line end: files with the same name, like __init__.py or index.js, share
+## their header, also between templates with the same lines and variables (e.g. from several --config rules)
+renderedHeaders = LRUCache(HEADER_CACHE_SIZE)
+
+class CompiledTemplate(object):
+    """A template which is read and substituted only once for all the files of a run.
+
+    All the lines of the template which do not refer to ${file_name} are substituted and encoded when the
+    template is compiled. For each type, the header is then pre-built with the encoded comment prefix and
+    suffix of the type, and only the lines which contain ${file_name} are substituted again per file.
+    If the file name is not included, all the files of a type share the same header, which is kept by the
+    template. Otherwise the headers are kept in renderedHeaders, so that they are only rendered once for
+    all the files with the same name, while the memory they take stays bounded.
+    Raises KeyError or ValueError if a variable of the template cannot be substituted.
+    """
+
+    def __init__(self, templateFile, dict):
+        with io.open(templateFile,'r') as f:
+            lines = f.readlines()
+        self.dict = dict.copy()
+        self.includeFile = bool(self.dict.get("includefile"))
+        self.dict["file_name"] = "This file"
+        ## each line is either the substituted and encoded line or, if it refers to the file name, a Template
+        self.lines = []
+        for line in lines:
+            template = Template(line)
+            substituted = template.substitute(self.dict)  ## use safe_substitute if we do not want an error
+            if self.includeFile and self._uses_file_name(template):
+                self.lines.append(template)
+            else:
+                self.lines.append(substituted.encode('utf8'))
+        import hashlib
+        h = hashlib.sha1()
+        for line in self.lines:
+            h.update(b"T" + line.template.encode('utf8') if isinstance(line, Template) else b"L" + line)
+        h.update(repr(sorted(self.dict.items())).encode('utf8'))
+        self.fingerprint = h.digest()
+        self.parts = {}
+        self.headers = {}
+
+    @staticmethod
+    def _uses_file_name(template):
+        for m in template.pattern.finditer(template.template):
+            if "file_name" in (m.group("named"), m.group("braced")):
+                return True
+        return False
+
+    def _parts_for_type(self, type):
+        """Return the header for type as a list of bytes and Templates, with adjacent bytes joined."""
+        parts = self.parts.get(type)
+        if parts is not None:
+            return parts
+        language = get_languages().get(type)
+        parts = [language.headerStart]
+        for line in self.lines:
+            if isinstance(line, Template):
+                parts[-1] += language.linePrefix
+                parts.append(line)
+                parts.append(language.lineSuffix)
+            else:
+                parts[-1] += language.linePrefix + line + language.lineSuffix
+        parts[-1] += language.headerEnd
+        self.parts[type] = parts
+        return parts
+
+    def header(self, type, fileName, newline=b"\n"):
+        """Return the utf8 encoded header for a file of the given type and name, with the given line ends."""
+        parts = self._parts_for_type(type)
+        if len(parts) == 1:
+            key = (type, newline)
+            header = self.headers.get(key)
+            if header is None:
+                header = self.headers[key] = parts[0] if newline == b"\n" else parts[0].replace(b"\n", newline)
+            return header
+        key = (self.fingerprint, type, fileName, newline)
+        header = renderedHeaders.get(key)
+        if header is None:
+            dict = self.dict.copy()
+            dict["file_name"] = fileName
+            header = b"".join([p if not isinstance(p, Template) else p.substitute(dict).encode('utf8') for p in parts])
+            if newline != b"\n":
+                header = header.replace(b"\n", newline)
+            renderedHeaders.put(key, header)
+        return header
+
+
+## read the header of a file and return a dictionary with the following elements:
+## lines: array of the lines read from the start of the file, as bytes with their line ends and without
+##   a BOM, which is only as much as was needed to find the header: the rest of the file is never read
+##   into memory. They are not decoded, but they must be valid UTF-8.
+## bodyOffset: the byte offset in the file of the first line which is not in lines
+## bom: the UTF-8 byte order mark at the start of the file, or b""
+## newline: the line end of the first line, b"\r\n" or b"\n", which is used for the new header
 ## skip: number of lines at the beginning to skip (always keep them when replacing or adding something)
 ##   can also be seen as the index of the first line not to skip
 ## headStart: index of first line of detected header, or None if non header detected
 ## headEnd: index of last line of detected header, or None
 ## yearsLine: index of line which contains the copyright years, or None
 ## haveLicense: found a line that matches a pattern that indicates this could be a license header
-## settings: the type settings
-## If the file is not supported, return None
-def read_file(file):
+## regexEvals: the number of regular expression evaluations done
+## type: the name of the language of the file
+## language: its Language
+## If the file is not supported, return None. If the lines are not valid UTF-8, raise UnicodeDecodeError.
+## With a window, only that many bytes at the start of the file are read and scanned, and a last line
+## cut off by the window is dropped; this is only good enough to find the yearsLine.
+def read_file(file, window=None):
+    languages = get_languages()
+    name = os.path.basename(file)
+    ## if the name cannot be of a supported type, return None without opening the file
+    if not languages.candidate(name):
+        return None
+    with io.open(file,'rb') as f:
+        language = languages.for_file(name, f)
+        logging.debug("Language of this file is %s",language)
+        if language is None:
+            return None
+        return read_header(f, language, window)
+
+## read the header from the binary file object f, which has the content of a file of the given Language, and
+## return the dictionary described for read_file
+def read_header(f, language, window=None):
+    lines = []
+    bom = f.read(len(codecs.BOM_UTF8))
+    if bom != codecs.BOM_UTF8:
+        bom = b""
+        f.seek(0)
+    if window is None:
+        dict = scan_header(f, lines, language.detector)
+        dict["bodyOffset"] = f.tell()
+    else:
+        head = f.read(window)
+        dict = scan_header(io.BytesIO(head), lines, language.detector)
+        if len(head) == window and lines and not lines[-1].endswith(b"\n"):
+            lines.pop()
+            if dict["yearsLine"] == len(lines):
+                dict["yearsLine"] = None
+        dict["bodyOffset"] = len(bom) + sum(len(line) for line in lines)
+    ## the lines are kept as they are, but the skipped lines and the header must be text we understand.
+    ## The line read after them belongs to the body, which can be in any encoding
+    b"".join(lines[:dict["skip"] if dict["headEnd"] is None else dict["headEnd"]+1]).decode('utf8')
+    dict["bom"] = bom
+    dict["newline"] = b"\r\n" if lines and lines[0].endswith(b"\r\n") else b"\n"
+    dict["type"] = language.name
+    dict["lines"] = lines
+    dict["language"] = language
+    return dict
+
+## wrap the source of a compiled pattern so that it keeps its flags inside a larger expression, and matches
+## with re.match wherever the pattern would match with re.search (or findall)
+def _anywhere(pattern):
+    if isinstance(pattern, (str, unicode)):
+        pattern = re.compile(pattern)
+    flags = ""
+    if pattern.flags & re.IGNORECASE:
+        flags += "i"
+    if pattern.flags & re.MULTILINE:
+        flags += "m"
+    if pattern.flags & re.DOTALL:
+        flags += "s"
+    if flags:
+        return ".*?(?" + flags + ":" + pattern.pattern + ")"
+    return ".*?(?:" + pattern.pattern + ")"
+
+## convert the source of a regular expression to the source of the same expression for utf8 encoded bytes.
+## Non ASCII characters are encoded as several bytes, so in a character class they have to become alternatives.
+def _bytes_source(source):
+    def convert(m):
+        chars = m.group(1)
+        if chars.startswith("^") or all(ord(c) < 128 for c in chars):
+            return m.group(0)
+        ascii = "".join(c for c in chars if ord(c) < 128)
+        others = [re.escape(c) for c in chars if ord(c) >= 128]
+        if ascii:
+            others.insert(0, "[" + ascii + "]")
+        return "(?:" + "|".join(others) + ")"
+    return re.sub(r"(?<!\\)\[((?:\\.|[^\]\\])+)\]", convert, source).encode('utf8')
+
+def _bytes_pattern(pattern):
+    """Compile the equivalent of a regular expression for utf8 encoded bytes."""
+    if isinstance(pattern, (str, unicode)):
+        pattern = re.compile(pattern)
+    return re.compile(_bytes_source(pattern.pattern), pattern.flags & (re.IGNORECASE | re.MULTILINE | re.DOTALL | re.VERBOSE))
+
+yearsBytesPattern = _bytes_pattern(yearsPattern)
+
+## an encoding declared in one of the first two lines of a file, like "# -*- coding: latin-1 -*-" (PEP 263,
+## also used by ruby and emacs) or <?xml version="1.0" encoding="latin-1"?>
+codingBytesPattern = re.compile(br"coding[:=]\s*[\"']?([-\w.]+)")
+
+## return the encoding the lines at the start of a file declare, if it is not utf8 (or ascii, a subset of it)
+## and so cannot take a header with other characters, otherwise None
+def declared_encoding(lines):
+    for line in lines[:2]:
+        m = codingBytesPattern.search(line)
+        if m:
+            encoding = m.group(1).decode('ascii')
+            try:
+                if codecs.lookup(encoding).name in ("utf-8", "utf-8-sig"):
+                    return None
+            except LookupError:
+                pass
+            return encoding
+    return None
+
+## a pattern of the form [^][\s*]literal[\s*$], with the literal capturing group
+_simplePattern = re.compile(r"(\^?)((?:\\s\*)?)((?:[^\\.^$*+?{}\[\]|()]|\\[^A-Za-z0-9])+)((?:\\s\*\$)?)\Z")
+
+## check if the source of a regular expression has a | outside of any group or character class
+def _has_alternation(source):
+    depth = 0
+    i = 0
+    while i < len(source):
+        c = source[i]
+        if c == "\\":
+            i = i+1
+        elif c == "[":
+            ## skip the character class, a ] right at its start is part of it
+            i = source.find("]", i+2)
+            if i < 0:
+                return True
+        elif c == "(":
+            depth = depth+1
+        elif c == ")":
+            depth = depth-1
+        elif c == "|" and depth == 0:
+            return True
+        i = i+1
+    return False
+
+## return a function which tells if pattern matches a line of utf8 encoded bytes anywhere (like search or
+## findall), and a literal which must occur in a line for the pattern to match (in the lower case line if
+## ignoreCase), or b"" if there is no such literal: the literal is checked first, so that the function is only called on the few lines
+## which can match. For simple patterns like "^\s*#" or "\*/\s*$" the function does not use the regular
+## expression at all.
+def _line_test(pattern):
+    if isinstance(pattern, (str, unicode)):
+        pattern = re.compile(pattern)
+    ignoreCase = bool(pattern.flags & re.IGNORECASE)
+    bytesPattern = _bytes_pattern(pattern)
+    m = _simplePattern.match(pattern.pattern)
+    if m and not pattern.flags & (re.MULTILINE | re.VERBOSE):
+        anchored, spaces, literal, end = m.groups()
+        literal = re.sub(r"\\(.)", r"\1", literal)
+        if ignoreCase:
+            literal = literal.lower()
+        literal = literal.encode('utf8')
+        if end and not anchored:
+            test = lambda line: line.rstrip().lower().endswith(literal) if ignoreCase else line.rstrip().endswith(literal)
+        elif end:
+            test = bytesPattern.search
+        elif anchored and spaces:
+            test = lambda line: line.lstrip().lower().startswith(literal) if ignoreCase else line.lstrip().startswith(literal)
+        elif anchored:
+            test = lambda line: line.lower().startswith(literal) if ignoreCase else line.startswith(literal)
+        else:
+            ## an optional leading \s* does not change where the pattern can match
+            test = lambda line: True
+        return literal, ignoreCase, test
+    ## otherwise use the literal at the start of the pattern, if there is one
+    m = re.match(r"(?:[^\\.^$*+?{}\[\]|()]|\\[^A-Za-z0-9])+", pattern.pattern)
+    literal = ""
+    if m and not _has_alternation(pattern.pattern):
+        literal = re.sub(r"\\(.)", r"\1", m.group(0))
+        if pattern.pattern[m.end():m.end()+1] in ("?", "*", "{"):
+            literal = literal[:-1]
+        if ignoreCase:
+            literal = literal.lower()
+    return literal.encode('utf8'), ignoreCase, bytesPattern.search
+
+class Detector(object):
+    """The header detection patterns of a Language, compiled so that each line is classified in one pass.
+
+    Before the header, each line is classified by a single match of a combined expression, an alternation
+    of named groups in the order in which the patterns were tried one after the other before, and the
+    name of the group that matched tells the result:
+      first: for the first line, "keep" (keepFirst), "empty", "start" of a block comment (or of a line
+        comment for a type without block comments) or "line" for a line comment of a type with block comments
+      more: the same for the following lines, with keepMore for "keep"
+    Within the header, where most of the lines are, the lines are classified by classify(), which first
+    checks for the literals which the license, years and end of comment patterns need, and only uses
+    the patterns on lines that contain them.
+    All of this works on the raw utf8 encoded lines, which are never decoded.
+    """
+
+    def __init__(self, language):
+        keepFirst = language.keepFirst
+        keepMore = language.keepMore
+        blockCommentStartPattern = language.blockCommentStartPattern
+        blockCommentEndPattern = language.blockCommentEndPattern
+        lineCommentStartPattern = language.lineCommentStartPattern
+        start = []
+        if blockCommentStartPattern:
+            start.append("(?P<start>" + _anywhere(blockCommentStartPattern) + ")")
+            if lineCommentStartPattern:
+                start.append("(?P<line>" + _anywhere(lineCommentStartPattern) + ")")
+        elif lineCommentStartPattern:
+            start.append("(?P<start>" + _anywhere(lineCommentStartPattern) + ")")
+        empty = ["(?P<empty>" + _anywhere(emptyPattern) + ")"]
+        keep = ["(?P<keep>" + _anywhere(keepFirst) + ")"] if keepFirst else []
+        self.first = re.compile(_bytes_source("|".join(keep + empty + start)))
+        keep = ["(?P<keep>" + _anywhere(keepMore) + ")"] if keepMore else []
+        self.more = re.compile(_bytes_source("|".join(keep + empty + start)))
+        self.isBlock = bool(blockCommentStartPattern)
+        self.license = _line_test(licensePattern)
+        self.years = _line_test(yearsPattern)
+        if self.isBlock:
+            self.end = _line_test(blockCommentEndPattern)
+        if lineCommentStartPattern:
+            self.comment = _line_test(lineCommentStartPattern)
+
+    def classify(self, line, isBlock):
+        """Classify a line of the header and return the kind and the number of pattern evaluations done.
+
+        For a header in a block comment (isBlock), the kind is one of "license", "end" (blockCommentEndPattern),
+        "years" or "text", in this order of precedence. For a header of line comments, also in a type with
+        block comments, it is one of "license", "years", "comment" or None at the end of the comment.
+        """
+        lower = line.lower()
+        evals = 0
+        if not isBlock:
+            literal, ignoreCase, test = self.comment
+            if literal not in (lower if ignoreCase else line):
+                return None, evals
+            evals = evals + 1
+            if not test(line):
+                return None, evals
+        literal, ignoreCase, test = self.license
+        if literal in (lower if ignoreCase else line):
+            evals = evals + 1
+            if test(line):
+                return "license", evals
+        if isBlock:
+            literal, ignoreCase, test = self.end
+            if literal in (lower if ignoreCase else line):
+                evals = evals + 1
+                if test(line):
+                    return "end", evals
+        literal, ignoreCase, test = self.years
+        if literal in (lower if ignoreCase else line):
+            evals = evals + 1
+            if test(line):
+                return "years", evals
+        return ("text" if isBlock else "comment"), evals
+
+## read lines from the binary file f and append them to lines until the header is found and ended, or
+## we know there is no header. Returns the skip, headStart, headEnd, yearsLine, haveLicense and regexEvals
+## elements described for read_file
+def scan_header(f, lines, detector):
     skip = 0
     headStart = None
-    headEnd = None
     yearsLine = None
     haveLicense = False
-    extension = os.path.splitext(file)[1]
-    logging.debug("File extension is %s",extension)
-    ## if we have no entry in the mapping from extensions to processing type, return None
-    type = ext2type.get(extension)
-    logging.debug("Type for this file is %s",type)
-    if not type:
-        return None
-    settings = typeSettings.get(type)
-    with io.open(file,'r', encoding='utf8') as f:
-        lines = f.readlines()
-    ## now iterate throw the lines and try to determine the various indies
     ## first try to find the start of the header: skip over shebang or empty lines
-    keepFirst = settings.get("keepFirst")
-    keepMore = settings.get("keepMore")
-    blockCommentStartPattern = settings.get("blockCommentStartPattern")
-    blockCommentEndPattern = settings.get("blockCommentEndPattern")
-    lineCommentStartPattern = settings.get("lineCommentStartPattern")
     i = 0
-    for line in lines:
-        if i==0 and keepFirst and keepFirst.findall(line):
-            skip = skip + 1
-        elif i>0 and keepMore and keepMore.findall(line):
-            skip = skip + 1
-        elif emptyPattern.findall(line):
-            pass
-        elif blockCommentStartPattern and blockCommentStartPattern.findall(line):
-            headStart = i
-            break
-        elif lineCommentStartPattern and lineCommentStartPattern.findall(line):
-            headStart = i
-            break
-        elif not blockCommentStartPattern and lineCommentStartPattern and lineCommentStartPattern.findall(line):
+    pattern = detector.first
+    for line in f:
+        lines.append(line)
+        m = pattern.match(line)
+        if m is None:
+            ## we have reached something else, so no header in this file
+            return {"skip":skip, "headStart":None, "headEnd":None, "yearsLine": None, "haveLicense": haveLicense, "regexEvals": i+1}
+        kind = m.lastgroup
+        if kind == "start" or kind == "line":
             headStart = i
             break
-        else:
-            ## we have reached something else, so no header in this file
-            #logging.debug("Did not find the start giving up at line %s, line is >%s<",i,line)
-            return {"type":type, "lines":lines, "skip":skip, "headStart":None, "headEnd":None, "yearsLine": None, "settings":settings, "haveLicense": haveLicense}
+        if kind == "keep":
+            skip = skip + 1
+        pattern = detector.more
         i = i+1
-    #logging.debug("Found preliminary start at %s",headStart)
     ## now we have either reached the end, or we are at a line where a block start or line comment occurred
     # if we have reached the end, return default dictionary without info
-    if i == len(lines):
-        #logging.debug("We have reached the end, did not find anything really")
-        return {"type":type, "lines":lines, "skip":skip, "headStart":headStart, "headEnd":headEnd, "yearsLine": yearsLine, "settings":settings, "haveLicense": haveLicense}
-    # otherwise process the comment block until it ends
-    if blockCommentStartPattern:
-        for j in range(i,len(lines)):
-            #logging.debug("Checking line %s",j)
-            if licensePattern.findall(lines[j]):
-                haveLicense = True
-            elif blockCommentEndPattern.findall(lines[j]):
-                return {"type":type, "lines":lines, "skip":skip, "headStart":headStart, "headEnd":j, "yearsLine": yearsLine, "settings":settings, "haveLicense": haveLicense}
-            elif yearsPattern.findall(lines[j]):
-                haveLicense = True
-                yearsLine = j
+    if headStart is None:
+        return {"skip":skip, "headStart":None, "headEnd":None, "yearsLine": None, "haveLicense": haveLicense, "regexEvals": i}
+    # otherwise process the comment block until it ends, reading more lines as we go. A header of line
+    # comments ends with the comments, even in a type with block comments
+    isBlock = detector.isBlock and kind == "start"
+    j = i
+    line = lines[i]
+    evals = i
+    classify = detector.classify
+    while True:
+        kind, n = classify(line, isBlock)
+        evals = evals + n
+        if kind == "license":
+            haveLicense = True
+        elif kind == "years":
+            haveLicense = True
+            yearsLine = j
+        elif kind == "end":
+            return {"skip":skip, "headStart":headStart, "headEnd":j, "yearsLine": yearsLine, "haveLicense": haveLicense, "regexEvals": evals}
+        elif kind is None:
+            ## the end of a line comment
+            return {"skip":skip, "headStart":i, "headEnd":j-1, "yearsLine": yearsLine, "haveLicense": haveLicense, "regexEvals": evals}
+        line = f.readline()
+        if not line:
+            break
+        lines.append(line)
+        j = j+1
+    if isBlock:
         # if we went through all the lines without finding an end, maybe we have some syntax error or some other
         # unusual situation, so lets return no header
-        #logging.debug("Did not find the end of a block comment, returning no header")
-        return {"type":type, "lines":lines, "skip":skip, "headStart":None, "headEnd":None, "yearsLine": None, "settings":settings, "haveLicense": haveLicense}
-    else:
-        for j in range(i,len(lines)-1):
-            if lineCommentStartPattern.findall(lines[j]) and licensePattern.findall(lines[j]):
-                haveLicense = True
-            elif not lineCommentStartPattern.findall(lines[j]):
-                return {"type":type, "lines":lines, "skip":skip, "headStart":i, "headEnd":j-1, "yearsLine": yearsLine, "settings":settings, "haveLicense": haveLicense}
-            elif yearsPattern.findall(lines[j]):
-                haveLicense = True
-                yearsLine = j
-        ## if we went through all the lines without finding the end of the block, it could be that the whole
-        ## file only consisted of the header, so lets return the last line index
-        return {"type":type, "lines":lines, "skip":skip, "headStart":i, "headEnd":len(lines)-1, "yearsLine": yearsLine, "settings":settings, "haveLicense": haveLicense}
+        return {"skip":skip, "headStart":None, "headEnd":None, "yearsLine": None, "haveLicense": haveLicense, "regexEvals": evals}
+    ## if we went through all the lines without finding the end of the block, it could be that the whole
+    ## file only consisted of the header, so lets return the last line index
+    return {"skip":skip, "headStart":i, "headEnd":j, "yearsLine": yearsLine, "haveLicense": haveLicense, "regexEvals": evals}
+
+## write a new version of the file described by the read_file dictionary: its BOM, the read lines before start,
+## then the encoded newData, then the read lines from end on, then the rest of the original file which was not
+## read by read_file, copied over in large chunks.
+## The new content goes to a temporary file in the same directory, which gets the permissions and (if allowed)
+## the owner of the original and then atomically replaces it, so the original is never left half written.
+## If file is a symbolic link, the file it points to is replaced and the link is kept. A file with several
+## hard links is replaced under this name only, which leaves the other names with the old content, like an
+## editor which saves to a new file would; the in place patching below changes it under all its names.
+## Files of at least MMAP_THRESHOLD bytes are memory mapped and the rest is written from the map in one go,
+## and if newData has the same length as the lines it replaces (e.g. when only the years change), they are
+## just overwritten in the original file, unless a backup is made (the backup is a hard link to the same file).
+## With fsync "file" the new file and its directory are flushed to disk right away, with "dir" only the file
+## (the caller flushes the directories later, see fsync_paths), with "end" or "none" nothing is flushed here.
+## With backup, the original is kept as file.bak.
+## A file which cannot be written (e.g. read-only, or not checked out for editing in a version control system
+## which locks files) is left alone with a PermissionError, although replacing it only needs its directory to
+## be writable.
+## Returns the number of bytes written.
+def write_file(file, dict, newData, start, end, fsync="none", backup=False):
+    lines = dict["lines"]
+    target = os.path.realpath(file)
+    if not os.access(target, os.W_OK):
+        import errno
+        raise OSError(errno.EACCES, os.strerror(errno.EACCES), file)
+    st = os.stat(file)
+    large = st.st_size >= MMAP_THRESHOLD
+    if large and not backup:
+        old = b"".join(lines[start:end])
+        if len(old) == len(newData):
+            offset = len(dict["bom"]) + sum(len(line) for line in lines[0:start])
+            if patch_file(file, offset, newData, fsync):
+                return len(newData)
+    import shutil
+    import tempfile
+    dirName = os.path.dirname(target)
+    fd, tmpFile = tempfile.mkstemp(prefix="."+os.path.basename(target)+".", suffix=".tmp", dir=dirName)
+    try:
+        with io.open(fd, 'wb') as fw:
+            fw.write(dict["bom"])
+            fw.writelines(lines[0:start])
+            fw.write(newData)
+            fw.writelines(lines[end:])
+            with io.open(file, 'rb') as f:
+                if large:
+                    mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                    try:
+                        with memoryview(mm) as view:
+                            with view[dict["bodyOffset"]:] as body:
+                                fw.write(body)
+                    finally:
+                        mm.close()
+                else:
+                    f.seek(dict["bodyOffset"])
+                    shutil.copyfileobj(f, fw, COPY_BUFSIZE)
+            if fsync in ("file", "dir"):
+                fw.flush()
+                os.fsync(fw.fileno())
+            written = fw.tell()
+        shutil.copymode(target, tmpFile)
+        if hasattr(os, "chown"):
+            try:
+                os.chown(tmpFile, st.st_uid, st.st_gid)
+            except OSError:
+                ## only root can give a file away, keep our own ownership then
+                pass
+        if backup:
+            make_backup(file)
+        os.replace(tmpFile, target)
+    except:
+        os.remove(tmpFile)
+        raise
+    if fsync == "file":
+        fsync_paths([dirName])
+    return written
 
+## overwrite the bytes at offset in file with data, through a memory map, and flush them with fsync "file" or
+## "dir". Returns False if the file cannot be opened for writing, so that it has to be replaced instead.
+def patch_file(file, offset, data, fsync="none"):
+    try:
+        f = io.open(file, 'r+b')
+    except (IOError, OSError):
+        return False
+    with f:
+        mm = mmap.mmap(f.fileno(), 0)
+        try:
+            mm[offset:offset+len(data)] = data
+            if fsync in ("file", "dir"):
+                mm.flush()
+        finally:
+            mm.close()
+    return True
+
+## keep the current version of file as file.bak. As the file is about to be replaced by a new one rather than
+## changed, the backup is just a hard link to the original, so nothing is copied unless the file system does
+## not support hard links.
 def make_backup(file):
-    copyfile(file,file+".bak")
+    backupFile = file+".bak"
+    if os.path.lexists(backupFile):
+        os.remove(backupFile)
+    try:
+        os.link(file, backupFile)
+    except (OSError, AttributeError):
+        import shutil
+        shutil.copyfile(file,backupFile)
+
+def fsync_paths(paths):
+    """Flush files or directories to disk. Directories cannot be flushed on all platforms, which is ignored."""
+    for path in paths:
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except OSError as e:
+            logging.warning("Cannot open %s to flush it: %s",path,e)
+            continue
+        try:
+            os.fsync(fd)
+        except OSError:
+            if not os.path.isdir(path):
+                raise
+        finally:
+            os.close(fd)
+
+def find_template(opt_tmpl, out=None):
+    """Resolve a template name or file name to a template file.
+
+    Returns the path of the template file, or None if the name could not be resolved, in which case
+    the reason has already been printed to out (standard output if None).
+    """
+    print("file path: ",os.path.abspath(__file__), file=out)
+    templates = builtin_templates()
+    ## filter by trying to match the name against what was specified, a name which matches exactly
+    ## wins over the ones which only contain it (lgpl-v3 and lgpl-v3-multipart)
+    tmpls = [t for t in templates if opt_tmpl == t[0]] or [t for t in templates if opt_tmpl in t[0]]
+    if len(tmpls) == 1:
+        print("Using template ",tmpls[0][0], file=out)
+        return tmpls[0][1]
+    if len(tmpls) == 0:
+        ## check if we can interpret the option as file
+        if os.path.isfile(opt_tmpl):
+            print("Using file ",os.path.abspath(opt_tmpl), file=out)
+            return os.path.abspath(opt_tmpl)
+        print("Not a built-in template and not a file, cannot proceed: ", opt_tmpl, file=out)
+        print("Built in templates: ", ", ".join([t[0] for t in templates]), file=out)
+        return None
+    ## notify that there are multiple matching templates
+    print("There are multiple matching template names: ",[t[0] for t in tmpls], file=out)
+    return None
+
+## return the copyright years which should replace the existing years old, both encoded: the new years, or
+## with merge a range from the first of the existing years to the last of the new years if that is later,
+## e.g. 2016 and 2026 give 2016-2026, 2016-2020 and 2024-2026 give 2016-2026
+def new_years(old, years, merge=False):
+    if not merge:
+        return years
+    first, _, last = old.partition(b"-")
+    ## a short end year like in 2016-20 has the leading digits of the first year
+    last = first[:len(first)-len(last)] + last
+    newLast = years.split(b"-")[-1]
+    if len(newLast) != len(last) or newLast <= last:
+        return old
+    return first + b"-" + newLast
+
+class Rules(object):
+    """The rules of a --config file, which give the files below some paths their own template and settings.
+
+    The config file is JSON with a list of rules, each with a "path" and any of "template" (a built-in
+    template, a template file relative to the config file, or null to only update the years), "years",
+    "owner", "projectname" and "projecturl", which replace the ones of the base context (the command line):
+        {"rules": [{"path": "core/", "template": "apache-2"},
+                   {"path": "plugins/", "template": "gpl-v3", "projectname": "Plugins"}]}
+    A path is a glob like in .gitignore, but always relative to the directory of the config file: it
+    applies to the file or directory it matches and to everything below it, with a trailing / only to a
+    directory, and ** matches any number of directories.
+    The rules are kept in a trie of the literal directories their paths start with, so that only the rules
+    of the directories of a file are tried, which takes time proportional to its depth. The rule of the
+    deepest directory wins, and of the rules of one directory the last one which matches. Each rule has
+    its own context, with a CompiledTemplate which keeps its headers.
+    Raises ValueError if the config file or a rule is not valid, or its template cannot be used.
+    """
+
+    KEYS = ("path", "template", "years", "owner", "projectname", "projecturl")
+
+    def __init__(self, file, context):
+        import json
+        self.file = os.path.abspath(file)
+        self.base = os.path.dirname(self.file)
+        with io.open(self.file, 'rb') as f:
+            self.source = f.read()
+        try:
+            rules = json.loads(self.source.decode('utf8'))["rules"]
+        except (ValueError, KeyError, TypeError) as e:
+            raise ValueError("Invalid config file {}: {}".format(file, e))
+        ## the trie: each node is a tuple of a dict of the child nodes by name and a list of (regex, context)
+        self.root = ({}, [])
+        self.contexts = []
+        for rule in rules:
+            unknown = set(rule) - set(self.KEYS)
+            if unknown or not rule.get("path"):
+                raise ValueError("Invalid rule {} in {}: it needs a path and can only have {}".format(
+                    rule, file, ", ".join(self.KEYS)))
+            overrides = self._context(rule, context)
+            self.contexts.append(overrides)
+            regex, prefix = self._compile(rule["path"])
+            node = self.root
+            for name in prefix:
+                node = node[0].setdefault(name, ({}, []))
+            node[1].append((regex, len(self.contexts) - 1))
+        ## the complete context of each rule, by rule and check flag of the context it is used with
+        self.cache = {}
+
+    def _context(self, rule, context):
+        """Return the items of the context which a rule replaces."""
+        settings = dict(context["settings"])
+        settings.update((key, rule[key]) for key in self.KEYS[2:] if key in rule)
+        years = settings.get("years")
+        tmplFile = context["tmplFile"]
+        if "template" in rule:
+            tmplFile = rule["template"]
+            if tmplFile and os.path.isfile(os.path.join(self.base, tmplFile)):
+                tmplFile = os.path.join(self.base, tmplFile)
+            elif tmplFile:
+                tmplFile = find_template(tmplFile, io.StringIO())
+                if not tmplFile:
+                    raise ValueError("Unknown or ambiguous template in rule for {}: {}".format(rule["path"], rule["template"]))
+        compiled = None
+        if tmplFile:
+            try:
+                compiled = CompiledTemplate(tmplFile, settings)
+            except (KeyError, ValueError) as e:
+                raise ValueError("Cannot substitute the variables of template {} for {}: {}".format(tmplFile, rule["path"], e))
+        elif not years:
+            raise ValueError("No template and no years for the rule for " + rule["path"])
+        return {"tmplFile": tmplFile, "template": compiled, "settings": settings, "years": years}
+
+    @staticmethod
+    def _compile(path):
+        """Compile the path of a rule, return the regex and the literal directories it starts with."""
+        if path.startswith("./") or path == ".":
+            path = path[2:]
+        dirOnly = path.endswith("/")
+        path = path.strip("/")
+        if not path:
+            ## the whole tree
+            return re.compile(".*", re.DOTALL), []
+        regex = re.compile(glob_to_regex(path) + ("/.*" if dirOnly else "(?:/.*)?") + "\\Z", re.DOTALL)
+        names = path.split("/")
+        if not dirOnly:
+            names.pop()
+        prefix = []
+        for name in names:
+            if any(c in name for c in "*?["):
+                break
+            prefix.append(name)
+        return regex, prefix
+
+    def lookup(self, file):
+        """Return the index of the rule of a file, or None if no rule applies to it."""
+        relPath = relative_path(file, self.base)
+        names = relPath.split("/")
+        if names[0] == "..":
+            return None
+        found = None
+        node = self.root
+        for name in names:
+            for regex, index in reversed(node[1]):
+                if regex.match(relPath):
+                    found = index
+                    break
+            node = node[0].get(name)
+            if node is None:
+                break
+        return found
+
+    def context(self, file, context):
+        """Return the context to process a file with: the context of its rule, or context if none applies."""
+        index = self.lookup(file)
+        if index is None:
+            return context
+        key = (index, context["check"])
+        ruleContext = self.cache.get(key)
+        if ruleContext is None:
+            ruleContext = self.cache[key] = dict(context, rules=None, **self.contexts[index])
+        return ruleContext
+
+## classify the header of a file, as returned by read_file, without changing anything. Returns one of
+## "missing" if there is no header (or no years when only checking the years), "outdated" if the header only
+## differs in the years, "mismatch" if the header differs from the template otherwise, or "ok"
+def check_header(file, dict, context):
+    lines = dict["lines"]
+    template = context["template"]
+    if not template:
+        yearsLine = dict["yearsLine"]
+        if yearsLine is None:
+            return "missing"
+        m = yearsBytesPattern.search(lines[yearsLine])
+        if new_years(m.group(1), context["years"].encode('utf8'), context["mergeYears"]) != m.group(1):
+            return "outdated"
+        return "ok"
+    headStart = dict["headStart"]
+    headEnd = dict["headEnd"]
+    if headStart is None or headEnd is None or not dict["haveLicense"]:
+        return "missing"
+    header = template.header(dict["type"], os.path.basename(file), dict["newline"])
+    existing = b"".join(lines[headStart:headEnd+1])
+    if existing == header:
+        return "ok"
+    if yearsBytesPattern.sub(b"",existing) == yearsBytesPattern.sub(b"",header):
+        return "outdated"
+    return "mismatch"
+
+## process a single file and return a dictionary with the following elements:
+## file: the file name
+## action: one of "added", "replaced", "years" if the file was changed, "unchanged" if the file already
+##   had the right header or years, or None if the file was skipped (not supported or no years found)
+## status: with "check" in the context, nothing is changed and this is the result of check_header, or None
+##   if the file was skipped
+## error: a message if the file could not be processed, otherwise None
+## stats: the seconds spent in "detection", "rendering" and "writing", and the counts of "bytesRead",
+##   "linesScanned", "regexEvals" and "bytesWritten"
+## The context is a dictionary with the template file "tmplFile" (or None), its CompiledTemplate
+## "template", the template variables "settings", the "years" to use when only updating the years and
+## "check" to only check the files without changing them, "mergeYears" to merge the years with the existing
+## ones (see new_years), the "fsync" and "backup" options of write_file, and optionally the "rules" of a
+## config file, which replace the template, settings and years for the files they apply to. A file with
+## neither a template nor years is skipped.
+## This runs inside the worker pool, so it must not print anything: all output is done
+## by the caller from the returned dictionaries.
+def process_file(file, context):
+    stats = {"detection": 0.0, "rendering": 0.0, "writing": 0.0,
+             "bytesRead": 0, "linesScanned": 0, "regexEvals": 0, "bytesWritten": 0}
+    result = {"file": file, "action": None, "status": None, "error": None, "stats": stats}
+    try:
+        rules = context.get("rules")
+        if rules:
+            context = rules.context(file, context)
+        template = context["template"]
+        if not template and not context["years"]:
+            return result
+        start = timer()
+        dict = read_file(file, None if template else YEARS_WINDOW)
+        stats["detection"] = timer() - start
+        if not dict:
+            logging.debug("File not supported %s",file)
+            return result
+        stats["bytesRead"] = dict["bodyOffset"]
+        stats["linesScanned"] = len(dict["lines"])
+        stats["regexEvals"] = dict["regexEvals"]
+        logging.debug("Info for the file: headStart=%s, headEnd=%s, haveLicense=%s, skip=%s",dict["headStart"],dict["headEnd"],dict["haveLicense"],dict["skip"])
+        if context["check"]:
+            start = timer()
+            result["status"] = check_header(file, dict, context)
+            stats["rendering"] = timer() - start
+            return result
+        lines = dict["lines"]
+        ## the new data to write and the range of lines it replaces, if the file has to be changed
+        edit = None
+
+        ## if we have a template: replace or add
+        if template:
+            ## if we found a header, replace it
+            ## otherwise, add it after the lines to skip
+            headStart = dict["headStart"]
+            headEnd = dict["headEnd"]
+            haveLicense = dict["haveLicense"]
+            type = dict["type"]
+            skip = dict["skip"]
+            start = timer()
+            header = template.header(type, os.path.basename(file), dict["newline"])
+            stats["rendering"] = timer() - start
+            ## the header is utf8, which a file in another encoding cannot take unless it is all ascii
+            encoding = declared_encoding(lines)
+            if encoding and any(c >= 0x80 for c in bytearray(header)):
+                result["error"] = "The header is not ASCII, but the file declares the encoding " + encoding
+                return result
+            if headStart is not None and headEnd is not None and haveLicense:
+                ## only write if the new header is different from the existing one
+                if b"".join(lines[headStart:headEnd+1]) == header:
+                    result["action"] = "unchanged"
+                else:
+                    result["action"] = "replaced"
+                    edit = (header, headStart, headEnd+1)
+            else:
+                result["action"] = "added"
+                edit = (header, skip, skip)
+        else: ## no template lines, just update the years, if we found them
+            yearsLine = dict["yearsLine"]
+            if yearsLine is not None:
+                line = lines[yearsLine]
+                m = yearsBytesPattern.search(line)
+                years = new_years(m.group(1), context["years"].encode('utf8'), context["mergeYears"])
+                if years == m.group(1):
+                    result["action"] = "unchanged"
+                else:
+                    result["action"] = "years"
+                    ## only the years line is replaced; write_file overwrites it in place in large files if the
+                    ## years keep their length, and replaces other files atomically
+                    edit = (line[:m.start(1)] + years + line[m.end(1):], yearsLine, yearsLine+1)
+        if edit:
+            start = timer()
+            stats["bytesWritten"] = write_file(file, dict, edit[0], edit[1], edit[2], context["fsync"], context["backup"])
+            stats["writing"] = timer() - start
+    except (IOError, OSError, UnicodeError) as e:
+        result["error"] = str(e)
+    return result
+
+class RunStats(object):
+    """Timers and counters of a run for --stats, summed over all the files, and the slowest files.
+
+    The detection, rendering and writing times are summed over the files, so with --jobs they can add up
+    to more than the elapsed time of the run.
+    """
+
+    STAGES = ("discovery", "cache", "detection", "rendering", "writing")
+    COUNTERS = ("filesDiscovered", "filesProcessed", "bytesRead", "linesScanned", "regexEvals", "bytesWritten")
+
+    def __init__(self, slowest=STATS_SLOWEST):
+        self.start = timer()
+        self.seconds = collections.Counter()
+        self.counts = collections.Counter()
+        self.maxSlowest = slowest
+        ## heap of (seconds, file) of the slowest files seen so far
+        self.slowest = []
+
+    def add(self, result):
+        """Add the statistics of a result of process_file."""
+        stats = result["stats"]
+        self.counts["filesProcessed"] += 1
+        seconds = 0.0
+        for stage in ("detection", "rendering", "writing"):
+            self.seconds[stage] += stats[stage]
+            seconds += stats[stage]
+        for counter in ("bytesRead", "linesScanned", "regexEvals", "bytesWritten"):
+            self.counts[counter] += stats[counter]
+        import heapq
+        if len(self.slowest) < self.maxSlowest:
+            heapq.heappush(self.slowest, (seconds, result["file"]))
+        else:
+            heapq.heappushpop(self.slowest, (seconds, result["file"]))
+
+    def as_dict(self):
+        return {
+            "wallSeconds": timer() - self.start,
+            "seconds": dict((stage, self.seconds[stage]) for stage in self.STAGES),
+            "counts": dict((counter, self.counts[counter]) for counter in self.COUNTERS),
+            "slowest": [{"file": file, "seconds": seconds} for seconds, file in sorted(self.slowest, reverse=True)],
+        }
+
+    def report(self, format, out):
+        """Print the statistics as a table or as JSON."""
+        import json
+        data = self.as_dict()
+        if format == "json":
+            print(json.dumps(data, indent=2, sort_keys=True), file=out)
+            return
+        print("{:<20} {:>12}".format("stage", "seconds"), file=out)
+        for stage in self.STAGES:
+            print("{:<20} {:>12.3f}".format(stage, data["seconds"][stage]), file=out)
+        print("{:<20} {:>12.3f}".format("elapsed", data["wallSeconds"]), file=out)
+        print("", file=out)
+        for counter in self.COUNTERS:
+            print("{:<20} {:>12}".format(counter, data["counts"][counter]), file=out)
+        if data["slowest"]:
+            print("", file=out)
+            print("slowest files:", file=out)
+            for entry in data["slowest"]:
+                print("{:>12.6f}  {}".format(entry["seconds"], entry["file"]), file=out)
+
+def merge_stats(stats):
+    """Merge the RunStats.as_dict of several runs which ran side by side, e.g. the shards of a tree."""
+    merged = {"wallSeconds": max([s["wallSeconds"] for s in stats] or [0.0]),
+              "seconds": dict((stage, sum(s["seconds"].get(stage, 0.0) for s in stats)) for stage in RunStats.STAGES),
+              "counts": dict((counter, sum(s["counts"].get(counter, 0) for s in stats)) for counter in RunStats.COUNTERS)}
+    slowest = sorted((entry for s in stats for entry in s["slowest"]), key=lambda e: (-e["seconds"], e["file"]))
+    merged["slowest"] = slowest[:STATS_SLOWEST]
+    return merged
+
+def parse_shard(value):
+    """Parse the K/N of --shard into the tuple (K, N), K going from 1 to N."""
+    try:
+        index, count = [int(n) for n in value.split("/")]
+    except ValueError:
+        raise argparse.ArgumentTypeError("must be K/N, e.g. 2/4")
+    if count < 1 or not 1 <= index <= count:
+        raise argparse.ArgumentTypeError("K must be from 1 to N in K/N")
+    return index, count
+
+def relative_path(file, start_dir):
+    """Return the path of a file relative to start_dir with / separators, as used by Shard and --report."""
+    return os.path.relpath(file, start_dir).replace(os.sep, "/")
+
+class Shard(object):
+    """The files of one of count disjoint slices of a tree, for splitting a run over several machines.
+
+    Each file belongs to exactly one shard, the same on every machine: by default the one given by the
+    CRC-32 of its path relative to the processed directory. With weights, the seconds each file took in a
+    previous run (the "files" of a --report), the known files are instead spread so that the shards take
+    about the same time: from the slowest file on, each goes to the shard with the least seconds so far.
+    The files which are not in weights, e.g. new ones, still go by their hash.
+    """
+
+    def __init__(self, index, count, weights=None):
+        import heapq
+        self.index = index
+        self.count = count
+        ## the shard (from 0) of each file in weights
+        self.owners = {}
+        loads = [(0.0, k) for k in range(count)]
+        for path, seconds in sorted((weights or {}).items(), key=lambda w: (-w[1], w[0])):
+            load, k = heapq.heappop(loads)
+            self.owners[path] = k
+            heapq.heappush(loads, (load + seconds, k))
+
+    def owns(self, relPath):
+        """Tell if the file with the given relative path belongs to this shard."""
+        k = self.owners.get(relPath)
+        if k is None:
+            import zlib
+            k = (zlib.crc32(relPath.encode('utf8')) & 0xffffffff) % self.count
+        return k == self.index - 1
+
+def print_summary(counts, check=False, out=None):
+    """Print the counts of a run: with check, the statuses to out, otherwise the actions to standard output."""
+    if check:
+        print("Files ok: {}, missing: {}, outdated: {}, mismatch: {}, skipped: {}, errors: {}".format(
+            counts["ok"], counts["missing"], counts["outdated"], counts["mismatch"], counts["skipped"],
+            counts["errors"]), file=out)
+    else:
+        print("Files changed: {}, unchanged: {}, skipped: {}, errors: {}".format(
+            counts["changed"], counts["unchanged"], counts["skipped"], counts["errors"]))
+
+def write_report(file, report):
+    import json
+    with io.open(file, 'w', encoding='utf8') as f:
+        f.write(unicode(json.dumps(report, indent=1, sort_keys=True)))
+
+def merge_reports(argv):
+    """Combine the --report files of the shards of a run into one summary, see parse_command_line.
+
+    The counts and statistics are added up and the summary is printed like at the end of a run. The exit
+    status is 1 if any shard failed, or if the reports are not exactly the shards 1 to N of one run.
+    """
+    import json
+    parser = argparse.ArgumentParser(prog=program_name(argv) + " merge-reports",
+                                     description="Combine the --report files of the shards of a run")
+    parser.add_argument("reports", nargs="+", metavar="REPORT", help="The report files of the shards")
+    parser.add_argument("-o", "--output", dest="output", type=str, default=None, metavar="FILE",
+                        help="Save the combined report to FILE, which can be given to --shard-weights")
+    arguments = parser.parse_args(argv[2:])
+    reports = []
+    for file in arguments.reports:
+        try:
+            with io.open(file, 'r', encoding='utf8') as f:
+                report = json.load(f)
+            ## take the parts used below right away, so that a truncated or foreign file is reported by name
+            shard = report["shard"]
+            reports.append({"status": int(report["status"]), "check": bool(report["check"]),
+                            "shard": (int(shard[0]), int(shard[1])) if shard else None,
+                            "counts": dict((key, int(value)) for key, value in report["counts"].items()),
+                            "files": dict((key, float(value)) for key, value in report["files"].items()),
+                            "stats": report["stats"]})
+            merge_stats([report["stats"]])
+        except (IOError, OSError) as e:
+            print("Cannot read report ",file,": ",e, file=sys.stderr)
+            return 1
+        except (KeyError, TypeError, ValueError, AttributeError, IndexError) as e:
+            print("Not a valid report ",file,": ",type(e).__name__,e, file=sys.stderr)
+            return 1
+    status = max(report["status"] for report in reports)
+    check = reports[0]["check"]
+    if any(report["check"] != check for report in reports):
+        print("The reports mix runs with and without --check", file=sys.stderr)
+        status = 1
+    shards = [report["shard"] for report in reports]
+    counts = set(shard[1] for shard in shards if shard)
+    if None in shards or len(counts) != 1 or sorted(shard[0] for shard in shards) != list(range(1, counts.pop() + 1)):
+        print("The reports are not the shards 1 to N of one run: ",
+              ", ".join("{}/{}".format(*shard) if shard else "none" for shard in shards), file=sys.stderr)
+        status = 1
+    total = collections.Counter()
+    files = {}
+    for report in reports:
+        total.update(report["counts"])
+        files.update(report["files"])
+    print_summary(total, check, sys.stdout)
+    if arguments.output:
+        write_report(arguments.output, {"version": __version__, "shard": None, "check": check, "status": status,
+                                        "counts": dict(total), "stats": merge_stats([r["stats"] for r in reports]),
+                                        "files": files})
+    return status
+
+## return a string which changes whenever anything that influences the result of processing a file
+## changes: the version of this tool, the languages file, the template and the settings from the command line,
+## and whether the files are only checked, so that the runs with and without --check do not share their entries
+def fingerprint(context):
+    import hashlib
+    h = hashlib.sha1()
+    h.update(__version__.encode('utf8'))
+    with io.open(LANGUAGES_FILE,'rb') as f:
+        h.update(f.read())
+    if context["tmplFile"]:
+        with io.open(context["tmplFile"],'rb') as f:
+            h.update(f.read())
+    for key in sorted(context["settings"]):
+        h.update("{}={!r}\n".format(key, context["settings"][key]).encode('utf8'))
+    h.update("years={!r}\n".format(context["years"]).encode('utf8'))
+    h.update("mergeYears={!r}\n".format(context["mergeYears"]).encode('utf8'))
+    h.update("check={!r}\n".format(context["check"]).encode('utf8'))
+    rules = context.get("rules")
+    if rules:
+        h.update(rules.source)
+        for ruleContext in rules.contexts:
+            if ruleContext["tmplFile"]:
+                with io.open(ruleContext["tmplFile"],'rb') as f:
+                    h.update(f.read())
+    return h.hexdigest()
+
+def hash_file(file):
+    import hashlib
+    h = hashlib.sha1()
+    with io.open(file,'rb') as f:
+        while True:
+            chunk = f.read(COPY_BUFSIZE)
+            if not chunk:
+                break
+            h.update(chunk)
+    return h.hexdigest()
+
+class HeaderCache(object):
+    """Persistent record of the files that were already processed with the same fingerprint.
+
+    For each file the cache stores its modification time, size, inode and content hash after it
+    was processed. A file whose stat still matches is known to be up to date and does not have to
+    be read again; if only the modification time or inode changed (e.g. after a fresh checkout),
+    the content hash decides. All entries are dropped when the fingerprint changes. When the cache
+    holds more than maxEntries files, the entries which were not seen for the most runs are evicted.
+    """
+
+    def __init__(self, path, fingerprint, maxEntries=CACHE_MAX_ENTRIES):
+        import sqlite3
+        self.base = os.path.dirname(os.path.abspath(path))
+        self.maxEntries = maxEntries
+        self.db = sqlite3.connect(path)
+        self.db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, mtime_ns INTEGER, "
+                        "size INTEGER, inode INTEGER, hash TEXT, run INTEGER)")
+        meta = dict(self.db.execute("SELECT key, value FROM meta"))
+        if meta.get("fingerprint") != fingerprint:
+            logging.debug("Cache fingerprint changed, dropping all entries of %s",path)
+            self.db.execute("DELETE FROM files")
+            self.db.execute("INSERT OR REPLACE INTO meta VALUES ('fingerprint', ?)", (fingerprint,))
+        self.run = int(meta.get("run", 0)) + 1
+        self.db.execute("INSERT OR REPLACE INTO meta VALUES ('run', ?)", (str(self.run),))
+
+    def _key(self, file):
+        return os.path.relpath(os.path.abspath(file), self.base)
+
+    def is_current(self, file):
+        """Return True if the file is known to be up to date, without reading it if possible."""
+        key = self._key(file)
+        row = self.db.execute("SELECT mtime_ns, size, inode, hash FROM files WHERE path = ?", (key,)).fetchone()
+        if row is None:
+            return False
+        try:
+            st = os.stat(file)
+        except OSError:
+            return False
+        if (st.st_mtime_ns, st.st_size, st.st_ino) != tuple(row[0:3]):
+            if st.st_size != row[1] or hash_file(file) != row[3]:
+                return False
+        self.db.execute("UPDATE files SET mtime_ns = ?, inode = ?, run = ? WHERE path = ?",
+                        (st.st_mtime_ns, st.st_ino, self.run, key))
+        return True
+
+    def record(self, file):
+        """Remember the current state of a file which has just been processed."""
+        st = os.stat(file)
+        self.db.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)",
+                        (self._key(file), st.st_mtime_ns, st.st_size, st.st_ino, hash_file(file), self.run))
+
+    def close(self):
+        """Evict the stalest entries if there are too many and save the cache."""
+        count = self.db.execute("SELECT COUNT(*) FROM files").fetchone()[0]
+        if count > self.maxEntries:
+            self.db.execute("DELETE FROM files WHERE path IN (SELECT path FROM files ORDER BY run LIMIT ?)",
+                            (count - self.maxEntries,))
+        self.db.commit()
+        self.db.close()
+
+class HeaderProcessor(object):
+    """Adds, replaces or checks license headers, with everything set up once for any number of files.
+
+    This is the interface for using licenseheaders from other programs: the types, the template and the
+    options are set up when the processor is created, and the headers it renders are kept, so a long
+    running program can use one processor for many trees, files and buffers without any setup per call.
+    The arguments correspond to the command line options:
+    template: name of a built-in template or a template file, or None to only update the years
+    years: the years for ${years} in the template, or for the years only update
+    settings: the other template variables (owner, projectname, projecturl, includefile)
+    mergeYears, fsync, backup: the --merge-years, --fsync and --backup options
+    exclude, excludeGlob, gitignore: the --exclude substrings, --exclude-glob patterns and --gitignore, used when
+      walking directories
+    jobs, threads, concurrency: the --jobs, --threads and --async options
+    config: a --config file with rules which give the files below some paths their own template and
+      settings, see Rules; then template and years may be None for the files no rule applies to
+    Raises ValueError if there is nothing to do, or a template cannot be found or substituted.
+
+    Example:
+        processor = HeaderProcessor("mit", years="2026", settings={"owner": "Eager Hacker"})
+        for result in processor.process_paths(["src", "tools/setup.py"]):
+            print(result["file"], result["action"])
+    """
+
+    def __init__(self, template=None, years=None, settings=None, mergeYears=False, fsync="none", backup=False,
+                 exclude=(), gitignore=False, jobs=1, threads=False, concurrency=0, config=None, excludeGlob=()):
+        get_languages()
+        settings = dict(settings or {})
+        if years:
+            settings["years"] = years
+        tmplFile = None
+        compiled = None
+        if template:
+            tmplFile = template if os.path.isfile(template) else find_template(template, io.StringIO())
+            if not tmplFile:
+                raise ValueError("Unknown or ambiguous template: " + template)
+            try:
+                compiled = CompiledTemplate(tmplFile, settings)
+            except (KeyError, ValueError) as e:
+                raise ValueError("Cannot substitute the variables of template {}: {}".format(tmplFile, e))
+        elif not years and not config:
+            raise ValueError("No template and no years, nothing to do")
+        self.context = {"tmplFile": tmplFile, "template": compiled, "settings": settings, "years": years,
+                        "check": False, "mergeYears": mergeYears, "fsync": fsync, "backup": backup}
+        if config:
+            try:
+                self.context["rules"] = Rules(config, self.context)
+            except (IOError, OSError) as e:
+                raise ValueError("Cannot read config file {}: {}".format(config, e))
+        self.checkContext = dict(self.context, check=True)
+        self.exclude = list(exclude)
+        self.excludeGlob = list(excludeGlob)
+        self.gitignore = gitignore
+        self.jobs = jobs
+        self.threads = threads
+        self.concurrency = concurrency
+
+    def process_path(self, file, check=False):
+        """Process a single file and return the result dictionary of process_file.
+
+        With check, nothing is changed and the "status" of the result tells the state of the header.
+        """
+        return process_file(file, self.checkContext if check else self.context)
+
+    def process_files(self, files, check=False):
+        """Process the files of an iterable, which is consumed lazily, and yield the results in the same order."""
+        return process_all(files, self.checkContext if check else self.context, self.jobs, self.threads,
+                           self.concurrency)
+
+    def process_paths(self, paths, check=False):
+        """Like process_files, but each directory in paths stands for all the files below it."""
+        def files():
+            for path in paths:
+                if os.path.isdir(path):
+                    exclude = compile_excludes(self.excludeGlob, substrings=self.exclude, prefix=os.path.join(path, ""))
+                    for file in find_files(path, exclude, self.gitignore):
+                        yield file
+                else:
+                    yield path
+        return self.process_files(files(), check)
+
+    def check_bytes(self, data, fileName):
+        """Check the header of the content of a file, given as bytes, without anything being read or written.
+
+        The base name of fileName is used, with the shebang line of data, to get the type, and for
+        ${file_name}; the whole fileName selects the rule of the config, if any. Returns the status of
+        check_header, or None if the type of file is not supported or the file has neither a template
+        nor years. Raises UnicodeDecodeError if the header is not valid UTF-8.
+        """
+        context = self.checkContext
+        rules = context.get("rules")
+        if rules:
+            context = rules.context(fileName, context)
+        if not context["template"] and not context["years"]:
+            return None
+        f = io.BytesIO(data)
+        language = get_languages().for_file(os.path.basename(fileName), f)
+        if language is None:
+            return None
+        return check_header(fileName, read_header(f, language), context)
+
+## per-process state of a worker in the process pool, set up by init_worker
+_worker = {}
+
+def init_worker(context):
+    get_languages()
+    _worker.update(context)
+
+def process_batch(files, context=None):
+    """Process a list of files, using the worker state if no context is given."""
+    if context is None:
+        context = _worker
+    return [process_file(file, context) for file in files]
+
+def process_async(files, context, concurrency):
+    """Process the files with up to concurrency files in flight and yield the results in the same order.
+
+    The files are processed by an asyncio event loop which runs process_file in a pool of threads, so the
+    waiting for the opens, reads and writes of many files overlaps, while the detection and rendering
+    still happen one at a time. The results are taken in order, and the next file is only started when
+    the oldest one is done, so at most concurrency files are in flight and the files are produced lazily.
+    """
+    import asyncio
+    from concurrent.futures import ThreadPoolExecutor
+    loop = asyncio.new_event_loop()
+    executor = ThreadPoolExecutor(concurrency)
+    pending = collections.deque()
+    try:
+        for file in files:
+            pending.append(loop.run_in_executor(executor, process_file, file, context))
+            if len(pending) >= concurrency:
+                yield loop.run_until_complete(pending.popleft())
+        while pending:
+            yield loop.run_until_complete(pending.popleft())
+    finally:
+        for future in pending:
+            future.cancel()
+        executor.shutdown(wait=True)
+        loop.close()
+
+def process_all(files, context, jobs=1, threads=False, concurrency=0):
+    """Process all the files and yield the result dictionaries in the same order as the files.
+
+    With more than one job, the files are handed in batches to a pool of worker processes
+    (or threads), with a bounded number of batches in flight, so that the files can be
+    produced lazily and the results still come back in a deterministic order. With a
+    concurrency, they are processed by process_async instead.
+    """
+    if concurrency:
+        for result in process_async(files, context, concurrency):
+            yield result
+        return
+    if jobs <= 1:
+        for file in files:
+            yield process_file(file, context)
+        return
+    if threads:
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(jobs)
+        func = functools.partial(process_batch, context=context)
+    else:
+        import multiprocessing
+        pool = multiprocessing.Pool(jobs, initializer=init_worker, initargs=(context,))
+        func = process_batch
+    pending = collections.deque()
+    try:
+        batch = []
+        for file in files:
+            batch.append(file)
+            if len(batch) < JOB_BATCH_SIZE:
+                continue
+            pending.append(pool.apply_async(func, (batch,)))
+            batch = []
+            if len(pending) >= jobs * JOB_WINDOW:
+                for result in pending.popleft().get():
+                    yield result
+        if batch:
+            pending.append(pool.apply_async(func, (batch,)))
+        while pending:
+            for result in pending.popleft().get():
+                yield result
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+class InotifyWatcher(object):
+    """Reports the supported files which are created or renamed below a directory, using inotify.
+
+    Every directory of the tree which is not excluded gets a watch, and new directories get one as soon
+    as they show up. A new file is reported when it is closed after writing, so that it is not processed
+    half written, and a file renamed into the tree right away. Waiting for the events takes no CPU.
+    A .gitignore added while watching is only honoured for the directories created after it.
+    Raises OSError if inotify is not available or the tree cannot be watched.
+    """
+
+    ## the inotify(7) event flags
+    CLOSE_WRITE = 0x00000008
+    MOVED_TO = 0x00000080
+    CREATE = 0x00000100
+    Q_OVERFLOW = 0x00004000
+    IGNORED = 0x00008000
+    ONLYDIR = 0x01000000
+    ISDIR = 0x40000000
+
+    def __init__(self, start_dir, exclude=None, gitignore=False):
+        import ctypes
+        import ctypes.util
+        self.ctypes = ctypes
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+            self.add_watch = libc.inotify_add_watch
+            self.fd = libc.inotify_init1(os.O_CLOEXEC)
+        except (OSError, AttributeError, TypeError):
+            raise OSError("inotify is not available")
+        if self.fd < 0:
+            raise self._error(start_dir)
+        self.start_dir = start_dir
+        self.excludes = [exclude] if exclude else []
+        self.gitignore = gitignore
+        ## the directory, relative path and exclude patterns of each watch descriptor, as for walk_files
+        self.dirs = {}
+        ## files created but not yet closed
+        self.created = set()
+        try:
+            for file in walk_files(start_dir, "", self.excludes, gitignore, self._watch_first):
+                pass
+        except OSError:
+            self.close()
+            raise
+
+    def _error(self, path):
+        errno = self.ctypes.get_errno()
+        return OSError(errno, os.strerror(errno), path)
+
+    def _watch_first(self, dirPath, relDir, excludes):
+        if not self._watch(dirPath, relDir, excludes):
+            raise self._error(dirPath)
+
+    def _watch(self, dirPath, relDir, excludes):
+        wd = self.add_watch(self.fd, os.fsencode(dirPath),
+                            self.CLOSE_WRITE | self.MOVED_TO | self.CREATE | self.ONLYDIR)
+        if wd < 0:
+            return False
+        self.dirs[wd] = (dirPath, relDir, excludes)
+        return True
+
+    def _watch_new(self, dirPath, relDir, excludes):
+        if not self._watch(dirPath, relDir, excludes):
+            log.warning("Cannot watch directory %s: %s",dirPath,self._error(dirPath))
+
+    def wait(self):
+        """Wait until there are new files and return them."""
+        import select
+        import struct
+        files = []
+        while not files:
+            select.select([self.fd], [], [])
+            data = os.read(self.fd, 64 * 1024)
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, length = struct.unpack_from("iIII", data, offset)
+                name = os.fsdecode(data[offset+16:offset+16+length].rstrip(b"\0"))
+                offset += 16 + length
+                if mask & self.Q_OVERFLOW:
+                    ## events were lost, so look at the whole tree again
+                    log.warning("Too many file system events, scanning %s again",self.start_dir)
+                    files.extend(walk_files(self.start_dir, "", self.excludes, self.gitignore, self._watch_new))
+                    continue
+                if mask & self.IGNORED:
+                    self.dirs.pop(wd, None)
+                    continue
+                if wd not in self.dirs:
+                    continue
+                dirPath, relDir, excludes = self.dirs[wd]
+                path = os.path.join(dirPath, name)
+                relPath = relDir + name
+                if mask & self.ISDIR:
+                    if mask & (self.CREATE | self.MOVED_TO) and not os.path.islink(path) \
+                            and name not in VCS_DIRS and not is_excluded(relPath + "/", excludes):
+                        ## the directory may already have files in it
+                        files.extend(walk_files(path, relPath + "/", excludes, self.gitignore, self._watch_new))
+                elif not get_languages().candidate(name) or is_excluded(relPath, excludes):
+                    continue
+                elif mask & self.CREATE:
+                    self.created.add(path)
+                elif mask & self.MOVED_TO or (mask & self.CLOSE_WRITE and path in self.created):
+                    self.created.discard(path)
+                    files.append(path)
+        ## a file can be reported more than once, e.g. if it was written in a new directory
+        return list(collections.OrderedDict.fromkeys(files))
+
+    def close(self):
+        os.close(self.fd)
+
+class PollingWatcher(object):
+    """Reports the supported files which are created or renamed below a directory, like InotifyWatcher,
+    by looking for files which were not there every interval seconds. This works everywhere, also on
+    network file systems where inotify misses the changes made by other machines, but each look walks
+    the whole tree.
+    """
+
+    def __init__(self, start_dir, exclude=None, gitignore=False, interval=WATCH_INTERVAL):
+        self.start_dir = start_dir
+        self.exclude = exclude
+        self.gitignore = gitignore
+        self.interval = interval
+        self.known = set(find_files(start_dir, exclude, gitignore))
+
+    def wait(self):
+        """Wait until there are new files and return them."""
+        while True:
+            time.sleep(self.interval)
+            current = list(find_files(self.start_dir, self.exclude, self.gitignore))
+            files = [file for file in current if file not in self.known]
+            self.known = set(current)
+            if files:
+                return files
+
+    def close(self):
+        pass
+
+def make_watcher(start_dir, exclude=None, gitignore=False, poll=False):
+    """Return an InotifyWatcher for the tree, or a PollingWatcher if poll is set or inotify cannot be used."""
+    if not poll:
+        try:
+            return InotifyWatcher(start_dir, exclude, gitignore)
+        except OSError as e:
+            log.warning("Cannot watch %s for changes (%s), polling instead",start_dir,e)
+    return PollingWatcher(start_dir, exclude, gitignore)
+
+## return what tells if a file was changed since: its device, inode, modification time and size, or None
+## if it does not exist
+def file_state(file):
+    try:
+        st = os.stat(file)
+    except OSError:
+        return None
+    return (st.st_dev, st.st_ino, st.st_mtime_ns, st.st_size)
+
+def watch(processor, watcher, check=False, fsync="none", out=None, written=None):
+    """Process the new files reported by the watcher and print the results, until interrupted.
+
+    The files are processed one at a time in this process, with the template and types of the processor
+    which are set up already, so that a new file gets its header right away. The watcher also reports the
+    files this writes, so a file which is still as it was written is not processed again. written maps
+    the real paths of the files written before, e.g. by the run before watching, to their file_state.
+    """
+    written = dict(written or {})
+    try:
+        while True:
+            changed = []
+            for file in watcher.wait():
+                target = os.path.realpath(file)
+                if target in written and written.pop(target) == file_state(target):
+                    log.debug("Not processing %s again, it is as this run wrote it",file)
+                    continue
+                result = processor.process_path(file, check)
+                print_result(result, check, out)
+                if result["action"] in ("replaced", "added", "years"):
+                    changed.append(file)
+                    written[target] = file_state(target)
+            if fsync == "end":
+                fsync_paths(changed)
+            if fsync in ("dir", "end"):
+                fsync_paths(sorted(set(os.path.dirname(os.path.realpath(file)) for file in changed)))
+            sys.stdout.flush()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.close()
+
+def print_result(result, check=False, out=None):
+    """Print the result of processing a file: an error or the change made to out (standard output if None),
+    or with check the JSON line with the status to standard output."""
+    action = result["action"]
+    if result["error"]:
+        print("Error processing file ",result["file"],": ",result["error"], file=out)
+    elif check:
+        if result["status"]:
+            import json
+            print(json.dumps({"file": result["file"], "status": result["status"]}))
+    elif action == "replaced":
+        print("Replacing header in file ",result["file"], file=out)
+    elif action == "added":
+        print("Adding header to file ",result["file"], file=out)
+    elif action == "years":
+        print("Updating years in file ",result["file"], file=out)
+    elif action == "unchanged":
+        log.debug("Header already up to date in file %s",result["file"])
 
 def main():
     """Main function."""
+    if sys.argv[1:2] == ["merge-reports"]:
+        return merge_reports(sys.argv)
     logging.basicConfig(stream=sys.stderr, level=logging.INFO)
-    ## init: create the ext2type mappings
-    for t in typeSettings:
-        settings = typeSettings[t]
-        exts = settings["extensions"]
-        for ext in exts:
-            ext2type[ext] = t
-            patterns.append("*"+ext)
     try:
         error = False
         settings = {
         }
-        templateLines = None
         arguments = parse_command_line(sys.argv)
         if arguments.dir:
             start_dir = arguments.dir[0]
@@ -443,111 +2156,200 @@ def main():
         if arguments.includefile:
             settings["includefile"] = arguments.includefile
 
-        if arguments.exclude:
-            exclude = arguments.exclude
-        else:
-            exclude = []
+        if arguments.concurrency and arguments.jobs > 1:
+            print("--async cannot be combined with --jobs", file=sys.stderr)
+            return 1
+        if arguments.concurrency < 0:
+            print("The number of files for --async must be positive", file=sys.stderr)
+            return 1
+        if arguments.files_from and (arguments.since or arguments.staged):
+            print("--files-from cannot be combined with --since or --staged", file=sys.stderr)
+            return 1
+        if arguments.null and not arguments.files_from:
+            print("-0 only applies to --files-from", file=sys.stderr)
+            return 1
+        if arguments.shard and arguments.watch:
+            print("--shard cannot be combined with --watch", file=sys.stderr)
+            return 1
+        if arguments.shard_weights and not arguments.shard:
+            print("--shard-weights only applies to --shard", file=sys.stderr)
+            return 1
+
+        ## the paths of --files-from are taken as they are, the others start with the directory to process
+        exclude = compile_excludes(arguments.exclude_glob or [], substrings=arguments.exclude or [],
+                                   prefix="" if arguments.files_from else os.path.join(start_dir, ""))
 
+        ## with --check, standard output is reserved for the report
+        out = sys.stderr if arguments.check else sys.stdout
+
+        ## if we have a template name specified, try to get or load the template
+        tmplFile = None
         if arguments.tmpl:
-            opt_tmpl = arguments.tmpl[0]
-            ## first get all the names of our own templates
-            ## for this get first the path of this file
-            templatesDir = os.path.join(os.path.dirname(os.path.abspath(__file__)),"templates")
-            print("file path: ",os.path.abspath(__file__))
-            ## get all the templates in the templates directory
-            templates = [f for f in get_paths("*.tmpl",templatesDir)]
-            templates = [(os.path.splitext(os.path.basename(t))[0],t) for t in templates]
-            ## filter by trying to match the name against what was specified
-            tmpls = [t for t in templates if opt_tmpl in t[0]]
-
-        if not error:
-            #logging.debug("Got template lines: %s",templateLines)
-            ## now do the actual processing: if we did not get some error, we have a template loaded or no template at all
-            ## if we have no template, then we will have the years.
-            ## now process all the files and either replace the years or replace/add the header
-            logging.debug("Processing directory %s",start_dir)
-            logging.debug("Patterns: %s",patterns)
-            for file in get_paths(patterns,start_dir):
-                passed = True
-                for exc in exclude:
-                    if exc in file:
-                        passed = False
-                if not passed:
-                    continue
-                logging.debug("Processing file: %s",file)
-                fileName = os.path.basename(file)
-                
-                dict = read_file(file)
-                if not dict:
-                    logging.debug("File not supported %s",file)
+            tmplFile = find_template(arguments.tmpl[0], out)
+            if not tmplFile:
+                return 1
+        elif not arguments.years and not arguments.config:
+            print("No template specified and no years either, nothing to do", file=out)
+            return 1
+
+        try:
+            processor = HeaderProcessor(tmplFile, arguments.years and arguments.years[0], settings,
+                                        mergeYears=arguments.merge_years, fsync=arguments.fsync,
+                                        backup=arguments.backup, jobs=arguments.jobs, threads=arguments.threads,
+                                        concurrency=arguments.concurrency, config=arguments.config)
+        except ValueError as e:
+            print(e, file=out)
+            return 1
+
+        shard = None
+        if arguments.shard:
+            weights = None
+            if arguments.shard_weights:
+                import json
+                try:
+                    with io.open(arguments.shard_weights, 'r', encoding='utf8') as f:
+                        weights = json.load(f)["files"]
+                except (IOError, OSError, ValueError, KeyError) as e:
+                    print("Cannot read the weights of the shards: ",e, file=out)
+                    return 1
+            shard = Shard(arguments.shard[0], arguments.shard[1], weights)
+        ## the seconds taken by each file, by relative path, for the report
+        fileSeconds = {}
+
+        cache = None
+        if arguments.cache:
+            cache = HeaderCache(os.path.join(start_dir, arguments.cache), fingerprint(processor.checkContext if arguments.check else processor.context), arguments.cache_size)
+        counts = collections.Counter()
+        stats = RunStats()
+        profiler = None
+        if arguments.profile:
+            import cProfile
+            profiler = cProfile.Profile()
+            profiler.enable()
+        ## watch the tree from before the files are processed, so that no new file is missed
+        watcher = None
+        if arguments.watch:
+            watcher = make_watcher(start_dir, exclude, arguments.gitignore, arguments.watch == "poll")
+        ## the file_state of the files this run writes, by real path, which the watcher will report again
+        written = {}
+        ## files and directories still to flush to disk at the end, depending on the fsync policy
+        toSync = []
+        dirsToSync = set()
+
+        fileList = None
+        if arguments.files_from:
+            if arguments.files_from == "-":
+                fileList = sys.stdin.buffer
+            else:
+                try:
+                    fileList = io.open(arguments.files_from, "rb")
+                except (IOError, OSError) as e:
+                    print("Cannot read the list of files: ",e, file=out)
+                    return 1
+            candidates = read_file_list(fileList, b"\0" if arguments.null else b"\n", exclude)
+        elif arguments.since or arguments.staged:
+            import subprocess
+            try:
+                ## get the whole list up front, so that a git failure is reported before any file is processed
+                start = timer()
+                candidates = list(git_files(start_dir, arguments.since, arguments.staged, exclude))
+                stats.seconds["discovery"] += timer() - start
+            except (OSError, ValueError, subprocess.CalledProcessError) as e:
+                print("Cannot get the changed files from git: ",e, file=out)
+                return 1
+        else:
+            candidates = find_files(start_dir, exclude, arguments.gitignore)
+
+        def files():
+            candidateIter = iter(candidates)
+            while True:
+                start = timer()
+                file = next(candidateIter, None)
+                stats.seconds["discovery"] += timer() - start
+                if file is None:
+                    break
+                stats.counts["filesDiscovered"] += 1
+                if shard and not shard.owns(relative_path(file, start_dir)):
                     continue
-                # logging.debug("DICT for the file: %s",dict)
-                logging.debug("Info for the file: headStart=%s, headEnd=%s, haveLicense=%s, skip=%s",dict["headStart"],dict["headEnd"],dict["haveLicense"],dict["skip"])
-                lines = dict["lines"]
-
-                ## if we have a template name specified, try to get or load the template
-                if arguments.tmpl:
-                    if len(tmpls) == 1:
-                        tmplName = tmpls[0][0]
-                        tmplFile = tmpls[0][1]
-                        print("Using template ",tmplName)
-                        templateLines = read_template(tmplFile,fileName,settings)
-                    else:
-                        if len(tmpls) == 0:
-                            ## check if we can interpret the option as file
-                            if os.path.isfile(opt_tmpl):
-                                print("Using file ",os.path.abspath(opt_tmpl))
-                                templateLines = read_template(os.path.abspath(opt_tmpl),fileName,settings)
-                            else:
-                                print("Not a built-in template and not a file, cannot proceed: ", opt_tmpl)
-                                print("Built in templates: ", ", ".join([t[0] for t in templates]))
-                                error = True
-                                break
+                if cache:
+                    start = timer()
+                    current = cache.is_current(file)
+                    stats.seconds["cache"] += timer() - start
+                    if current:
+                        logging.debug("File up to date according to the cache: %s",file)
+                        if arguments.check:
+                            ## still report the file, like a file which was checked
+                            print_result({"file": file, "action": None, "status": "ok", "error": None}, True, out)
+                            counts["ok"] += 1
                         else:
-                            ## notify that there are multiple matching templates
-                            print("There are multiple matching template names: ",[t[0] for t in tmpls])
-                            error = True
-                            break
-                else: # no tmpl parameter
-                    if not arguments.years:
-                        print("No template specified and no years either, nothing to do")
+                            counts["unchanged"] += 1
+                        continue
+                logging.debug("Processing file: %s",file)
+                yield file
+
+        ## now process all the files and either replace the years or replace/add the header
+        logging.debug("Processing directory %s",start_dir)
+        for result in processor.process_files(files(), arguments.check):
+            action = result["action"]
+            status = result["status"]
+            stats.add(result)
+            if arguments.report:
+                fileStats = result["stats"]
+                fileSeconds[relative_path(result["file"], start_dir)] = \
+                    fileStats["detection"] + fileStats["rendering"] + fileStats["writing"]
+            print_result(result, arguments.check, out)
+            if result["error"]:
+                counts["errors"] += 1
+                error = True
+                continue
+            if arguments.check:
+                if status:
+                    counts[status] += 1
+                    if status != "ok":
                         error = True
-                        break
-
-                ## if we have a template: replace or add
-                if templateLines:
-                    # make_backup(file)
-                    with io.open(file,'w', encoding='utf8') as fw:
-                        ## if we found a header, replace it
-                        ## otherwise, add it after the lines to skip
-                        headStart = dict["headStart"]
-                        headEnd = dict["headEnd"]
-                        haveLicense = dict["haveLicense"]
-                        type = dict["type"]
-                        skip = dict["skip"]
-                        if headStart is not None and headEnd is not None and haveLicense:
-                            print("Replacing header in file ",file)
-                            ## first write the lines before the header
-                            fw.writelines(lines[0:headStart])
-                            ## now write the new header from the template lines
-                            fw.writelines(for_type(templateLines,type))
-                            ## now write the rest of the lines
-                            fw.writelines(lines[headEnd+1:])
-                        else:
-                            print("Adding header to file ",file)
-                            fw.writelines(lines[0:skip])
-                            fw.writelines(for_type(templateLines,type))
-                            fw.writelines(lines[skip:])
-                    ## TODO: remove backup unless option -b
-                else: ## no template lines, just update the line with the year, if we found a year
-                    yearsLine = dict["yearsLine"]
-                    if yearsLine is not None:
-                        # make_backup(file)
-                        with io.open(file, 'w', encoding='utf8') as fw:
-                            print("Updating years in file ",file)
-                            fw.writelines(lines[0:yearsLine])
-                            fw.write(yearsPattern.sub(arguments.years,lines[yearsLine]))
-                        ## TODO: remove backup
+                else:
+                    counts["skipped"] += 1
+                if cache and status == "ok":
+                    cache.record(result["file"])
+                continue
+            if action in ("replaced", "added", "years"):
+                if watcher:
+                    target = os.path.realpath(result["file"])
+                    written[target] = file_state(target)
+                if arguments.fsync == "end":
+                    toSync.append(result["file"])
+                if arguments.fsync in ("dir", "end"):
+                    dirsToSync.add(os.path.dirname(os.path.realpath(result["file"])))
+            ## a skipped file is not up to date, it is only not supported by this run
+            if cache and action:
+                cache.record(result["file"])
+            if action == "unchanged":
+                counts["unchanged"] += 1
+            elif action:
+                counts["changed"] += 1
+            else:
+                counts["skipped"] += 1
+        if fileList and fileList is not sys.stdin.buffer:
+            fileList.close()
+        fsync_paths(toSync)
+        fsync_paths(sorted(dirsToSync))
+        if profiler:
+            profiler.disable()
+            profiler.dump_stats(arguments.profile)
+        print_summary(counts, arguments.check, out)
+        if cache:
+            cache.close()
+        if arguments.stats:
+            stats.report(arguments.stats, sys.stderr)
+        if arguments.report:
+            write_report(arguments.report, {"version": __version__, "shard": arguments.shard,
+                                            "check": arguments.check, "status": 1 if error else 0,
+                                            "counts": dict(counts), "stats": stats.as_dict(), "files": fileSeconds})
+        if watcher:
+            print("Watching",start_dir,"for new files, stop with Ctrl-C", file=sys.stderr)
+            sys.stdout.flush()
+            watch(processor, watcher, arguments.check, arguments.fsync, out, written)
+        return 1 if error else 0
     finally:
         logging.shutdown()
 
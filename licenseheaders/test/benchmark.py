@@ -0,0 +1,402 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+
+"""Benchmark for licenseheaders on a generated source tree.
+
+Generates a tree of source files for every supported type, with a mix of header states, and times
+the stages of processing it separately: discovery, detection, rendering and writing. Then it times
+complete runs over the tree which bump the year, once with the template (update) and once only
+updating the years (years). The results can be saved as JSON and compared with the results of an
+earlier run, e.g. of a previous version.
+
+With --concurrency, it also times years only runs with --async and each of the given numbers of files
+in flight (async-N), and --latency adds a delay to every file open, stat and replace during these runs,
+to see how they would do on a file system with a high latency like an NFS mount.
+
+With --shards, it also times years only runs split over that many processes with --shard, like CI
+runners would, and checks that together they processed every file exactly once.
+
+With --startup, it times the startup of the command line tool instead, on an empty directory, both as
+python -m licenseheaders and as a script, and reports the time spent in imports from -X importtime.
+
+Example:
+    python benchmark.py --files 5000 --size 20000 --output new.json --compare old.json
+    python benchmark.py --latency 5 --concurrency 1,8,64
+    python benchmark.py --shards 4
+    python benchmark.py --names 20
+    python benchmark.py --startup 20
+"""
+
+from __future__ import unicode_literals
+from __future__ import print_function
+
+import os
+import sys
+import io
+import json
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import platform
+import subprocess
+import statistics
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+from licenseheaders import licenseheaders as lh
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+HEADER_STATES = ["none", "stale", "matching", "shebang"]
+
+## template variables used for the generated headers and the benchmarked runs
+SETTINGS = {"years": "2020-2026", "owner": "Benchmark Owner", "projectname": "Benchmark",
+            "projecturl": "https://example.com", "includefile": True}
+STALE_SETTINGS = dict(SETTINGS, years="2010-2011")
+
+
+def peak_rss_kb():
+    """Return the peak resident set size of this process in KiB, or None if not available."""
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    ## bytes on macOS, KiB elsewhere
+    return rss // 1024 if sys.platform == "darwin" else rss
+
+
+def generate_tree(root, files, size, depth, states, seed, tmplFile, names=0):
+    """Generate files of all the supported types below root and return their paths.
+
+    The types, header states (from states) and directories are spread evenly over the files,
+    each file gets lines of code until it is about size bytes long. With names, the files only
+    get that many different base names (per extension), like the __init__.py and index.js of a
+    real tree, otherwise each file has its own name.
+    """
+    rnd = random.Random(seed)
+    languages = lh.get_languages()
+    types = sorted(language.name for language in languages.languages)
+    matching = lh.CompiledTemplate(tmplFile, SETTINGS)
+    stale = lh.CompiledTemplate(tmplFile, STALE_SETTINGS)
+    paths = []
+    for i in range(files):
+        type = types[i % len(types)]
+        language = languages.get(type)
+        ## only the extensions which resolve to this language, e.g. not .py for script
+        exts = [e for e in language.extensions if languages.lookup("file" + e) is language]
+        ext = exts[(i // len(types)) % len(exts)]
+        state = states[i % len(states)]
+        dirs = ["d{}".format(rnd.randrange(4)) for _ in range(rnd.randint(0, depth))]
+        if names:
+            ## a group of files with different names in each directory
+            dirs.insert(0, "g{}".format(i // names))
+        dirName = os.path.join(root, *dirs)
+        if not os.path.isdir(dirName):
+            os.makedirs(dirName)
+        name = "file{}{}".format(i % names if names else i, ext)
+        path = os.path.join(dirName, name)
+        content = []
+        if state == "shebang" and language.keepFirst is not None:
+            content.append(b"#!/usr/bin/env tool\n")
+        if state in ("stale", "shebang"):
+            content.append(stale.header(type, name))
+        elif state == "matching":
+            content.append(matching.header(type, name))
+        length = sum(len(c) for c in content)
+        n = 0
+        while length < size:
+            line = "value_{} = {};\n".format(n, rnd.randrange(1000000)).encode("utf8")
+            content.append(line)
+            length += len(line)
+            n += 1
+        with io.open(path, "wb") as f:
+            f.write(b"".join(content))
+        paths.append(path)
+    return paths
+
+
+def update_tree(paths, tmplFile, years):
+    """Process all the files like a run with the given years, with the template if tmplFile is set, otherwise
+    only updating the years, and return the seconds it took and the number of files changed."""
+    settings = dict(SETTINGS, years=years)
+    context = {"tmplFile": tmplFile, "template": lh.CompiledTemplate(tmplFile, settings) if tmplFile else None,
+               "settings": settings, "years": years, "check": False, "mergeYears": False,
+               "fsync": "none", "backup": False}
+    start = time.time()
+    changed = sum(1 for p in paths if lh.process_file(p, context)["action"] in ("added", "replaced", "years"))
+    return time.time() - start, changed
+
+
+class SlowModule(object):
+    """Stand-in for a module, with the given functions delayed by latency seconds before each call."""
+
+    def __init__(self, module, latency, names):
+        self._module = module
+        for name in names:
+            setattr(self, name, self._delayed(getattr(module, name), latency))
+
+    @staticmethod
+    def _delayed(func, latency):
+        def delayed(*args, **kwargs):
+            time.sleep(latency)
+            return func(*args, **kwargs)
+        return delayed
+
+    def __getattr__(self, name):
+        return getattr(self._module, name)
+
+
+def update_years_async(paths, years, concurrency, latency):
+    """Update the years of all the files with process_all and the given concurrency, with latency seconds
+    added to each file system call, and return the seconds it took and the number of files changed."""
+    context = {"tmplFile": None, "template": None, "settings": dict(SETTINGS, years=years), "years": years,
+               "check": False, "mergeYears": False, "fsync": "none", "backup": False}
+    lh.io, lh.os = SlowModule(io, latency, ["open"]), SlowModule(os, latency, ["stat", "replace"])
+    try:
+        start = time.time()
+        changed = sum(1 for r in lh.process_all(paths, context, concurrency=concurrency) if r["action"] == "years")
+        return time.time() - start, changed
+    finally:
+        lh.io, lh.os = io, os
+
+
+def update_years_sharded(root, years, shards):
+    """Update the years of all the files below root with shards processes of the command line tool running
+    side by side, one per --shard, and return the seconds it took, the number of files changed and the number
+    of files processed according to merge-reports."""
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "licenseheaders.py")
+    reports = [os.path.join(root, "..", os.path.basename(root) + "-shard{}.json".format(k)) for k in range(1, shards + 1)]
+    try:
+        start = time.time()
+        processes = [subprocess.Popen([sys.executable, script, "-y", years, "-d", root,
+                                       "--shard", "{}/{}".format(k, shards), "--report", reports[k - 1]],
+                                      stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+                     for k in range(1, shards + 1)]
+        for process in processes:
+            process.wait()
+        seconds = time.time() - start
+        merged = reports[0] + ".merged"
+        status = subprocess.call([sys.executable, script, "merge-reports", "-o", merged] + reports,
+                                 stdout=subprocess.DEVNULL)
+        if status:
+            sys.exit("The shards failed")
+        with io.open(merged, "r", encoding="utf8") as f:
+            report = json.load(f)
+        os.remove(merged)
+        return seconds, report["counts"].get("changed", 0), len(report["files"])
+    finally:
+        for report in reports:
+            if os.path.exists(report):
+                os.remove(report)
+
+
+def measure_startup(runs):
+    """Run the command line tool runs times on an empty directory, as a module and as a script, and return
+    the median wall times in ms and the imports of one run of the module from -X importtime."""
+    root = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..")
+    empty = tempfile.mkdtemp(prefix="licenseheaders-startup-")
+    ## an installed package has its bytecode cached, so make sure it is written
+    env = dict(os.environ)
+    env.pop("PYTHONDONTWRITEBYTECODE", None)
+    options = ["-t", "mit", "-y", "2026", "-o", "Benchmark Owner", "-n", "Benchmark", "-u", "https://example.com",
+               "--check", "-d", empty]
+    commands = {"module": [sys.executable, "-m", "licenseheaders"] + options,
+                "script": [sys.executable, os.path.join(root, "licenseheaders", "licenseheaders.py")] + options}
+    try:
+        results = {}
+        for name, command in sorted(commands.items()):
+            subprocess.run(command, cwd=root, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            times = []
+            for _ in range(runs):
+                start = time.time()
+                subprocess.run(command, cwd=root, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+                times.append((time.time() - start) * 1000)
+            results[name + "_ms"] = statistics.median(times)
+        output = subprocess.run([sys.executable, "-X", "importtime"] + commands["module"][1:], cwd=root, env=env,
+                                stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True).stderr
+        imports = []
+        for line in output.splitlines():
+            if line.startswith("import time:") and "|" in line and "self [us]" not in line:
+                selfUs, cumulativeUs, name = line[len("import time:"):].split("|")
+                imports.append((int(selfUs), name.strip()))
+        results["imports"] = len(imports)
+        results["import_ms"] = sum(us for us, name in imports) / 1000.0
+        results["slowest_imports"] = [{"module": name, "ms": us / 1000.0} for us, name in sorted(imports)[-5:][::-1]]
+        return results
+    finally:
+        os.rmdir(empty)
+
+
+def print_startup(results, previous=None):
+    for key, label in (("module_ms", "python -m licenseheaders"), ("script_ms", "licenseheaders.py"),
+                       ("import_ms", "imports")):
+        change = ""
+        if previous and previous.get(key):
+            change = "{:+.1f}%".format((results[key] / previous[key] - 1) * 100)
+        print("{:<26} {:>8.1f} ms  {}".format(label, results[key], change))
+    print("{} modules imported, the slowest: {}".format(results["imports"], ", ".join(
+        "{} {:.1f} ms".format(i["module"], i["ms"]) for i in results["slowest_imports"])))
+
+
+def rate(count, seconds):
+    return count / seconds if seconds > 0 else None
+
+
+def run(arguments):
+    tmplFile = lh.find_template(arguments.tmpl, out=io.StringIO())
+    if not tmplFile:
+        sys.exit("Unknown template " + arguments.tmpl)
+    root = tempfile.mkdtemp(prefix="licenseheaders-bench-")
+    try:
+        start = time.time()
+        paths = generate_tree(root, arguments.files, arguments.size, arguments.depth,
+                              arguments.states.split(","), arguments.seed, tmplFile, arguments.names)
+        generated = time.time() - start
+        totalBytes = sum(os.path.getsize(p) for p in paths)
+        stages = {}
+
+        start = time.time()
+        found = list(lh.find_files(root))
+        stages["discovery"] = {"seconds": time.time() - start, "files": len(found)}
+
+        start = time.time()
+        dicts = [lh.read_file(p) for p in paths]
+        stages["detection"] = {"seconds": time.time() - start, "files": len(paths), "bytes": totalBytes,
+                               "lines": sum(len(d["lines"]) for d in dicts)}
+
+        lh.renderedHeaders.clear()
+        start = time.time()
+        template = lh.CompiledTemplate(tmplFile, SETTINGS)
+        headers = [template.header(d["type"], os.path.basename(p)) for p, d in zip(paths, dicts)]
+        stages["rendering"] = {"seconds": time.time() - start, "files": len(paths),
+                               "header_cache_hits": lh.renderedHeaders.hits}
+
+        seconds = 0.0
+        written = 0
+        for path, dict, header in zip(paths, dicts, headers):
+            if dict["headStart"] is not None and dict["headEnd"] is not None and dict["haveLicense"]:
+                start, end = dict["headStart"], dict["headEnd"]+1
+            else:
+                start = end = dict["skip"]
+            t = time.time()
+            lh.write_file(path, dict, header, start, end)
+            seconds += time.time() - t
+            written += 1
+        stages["writing"] = {"seconds": seconds, "files": written,
+                             "bytes": sum(os.path.getsize(p) for p in paths)}
+
+        ## all the files now have the header with the SETTINGS years, so both of these change every file
+        seconds, changed = update_tree(paths, tmplFile, "2020-2027")
+        stages["update"] = {"seconds": seconds, "files": changed}
+        seconds, changed = update_tree(paths, None, "2020-2028")
+        stages["years"] = {"seconds": seconds, "files": changed}
+
+        for n, concurrency in enumerate(arguments.concurrency):
+            seconds, changed = update_years_async(paths, "2020-{}".format(2030 + n), concurrency,
+                                                  arguments.latency / 1000.0)
+            stages["async-{}".format(concurrency)] = {"seconds": seconds, "files": changed}
+
+        if arguments.shards:
+            seconds, changed, processed = update_years_sharded(root, "2020-2040", arguments.shards)
+            if processed != len(paths):
+                sys.exit("The shards processed {} of {} files".format(processed, len(paths)))
+            stages["shards-{}".format(arguments.shards)] = {"seconds": seconds, "files": changed}
+
+        for stage in stages.values():
+            stage["files_per_s"] = rate(stage["files"], stage["seconds"])
+            if "bytes" in stage:
+                stage["mb_per_s"] = rate(stage["bytes"] / 1e6, stage["seconds"])
+            if "lines" in stage:
+                stage["lines_per_s"] = rate(stage["lines"], stage["seconds"])
+        return {
+            "version": lh.__version__,
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "parameters": {"files": arguments.files, "size": arguments.size, "depth": arguments.depth,
+                           "states": arguments.states, "seed": arguments.seed, "tmpl": arguments.tmpl,
+                           "latency": arguments.latency, "concurrency": arguments.concurrency,
+                           "shards": arguments.shards, "names": arguments.names},
+            "generate_seconds": generated,
+            "stages": stages,
+            "peak_rss_kb": peak_rss_kb(),
+        }
+    finally:
+        if arguments.keep:
+            print("Kept the generated tree in", root, file=sys.stderr)
+        else:
+            shutil.rmtree(root)
+
+
+def print_results(results, previous=None):
+    print("{:<12} {:>8} {:>10} {:>12} {:>10}  {}".format("stage", "files", "seconds", "files/s", "MB/s",
+                                                        "vs previous" if previous else ""))
+    for name, stage in sorted(results["stages"].items()):
+        change = ""
+        if previous and name in previous["stages"] and stage["files_per_s"] and previous["stages"][name]["files_per_s"]:
+            change = "{:+.1f}%".format((stage["files_per_s"] / previous["stages"][name]["files_per_s"] - 1) * 100)
+        print("{:<12} {:>8} {:>10.3f} {:>12.0f} {:>10}  {}".format(
+            name, stage["files"], stage["seconds"], stage["files_per_s"] or 0,
+            "{:.1f}".format(stage["mb_per_s"]) if stage.get("mb_per_s") else "-", change))
+    rendering = results["stages"]["rendering"]
+    if "header_cache_hits" in rendering:
+        print("rendering: {} of {} headers from the cache".format(rendering["header_cache_hits"], rendering["files"]))
+    detection = results["stages"]["detection"]
+    if detection.get("lines_per_s"):
+        print("detection: {:.0f} header lines/s".format(detection["lines_per_s"]))
+    print("peak RSS: {} KiB".format(results["peak_rss_kb"]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark licenseheaders on a generated source tree")
+    parser.add_argument("--files", type=int, default=2000, help="Number of files to generate (default: 2000)")
+    parser.add_argument("--size", type=int, default=4000, help="Approximate size of each file in bytes (default: 4000)")
+    parser.add_argument("--depth", type=int, default=3, help="Maximum directory depth (default: 3)")
+    parser.add_argument("--states", type=str, default=",".join(HEADER_STATES),
+                        help="Comma separated header states to spread over the files, from: " + ", ".join(HEADER_STATES))
+    parser.add_argument("--seed", type=int, default=1, help="Random seed for the generated tree (default: 1)")
+    parser.add_argument("--tmpl", type=str, default="mit", help="Template to use (default: mit)")
+    parser.add_argument("--output", type=str, default=None, help="Save the results as JSON to this file")
+    parser.add_argument("--compare", type=str, default=None, help="Compare with the JSON results of an earlier run")
+    parser.add_argument("--concurrency", type=str, default="",
+                        help="Comma separated numbers of files in flight to time years only runs with --async for")
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="Milliseconds added to each file open, stat and replace in the --concurrency runs")
+    parser.add_argument("--shards", type=int, default=0,
+                        help="Also time a years only run split over this many processes with --shard")
+    parser.add_argument("--names", type=int, default=0,
+                        help="Number of different base names of the files per extension (default: one per file)")
+    parser.add_argument("--startup", type=int, default=0, metavar="RUNS",
+                        help="Time the startup of the command line tool over RUNS runs instead of processing a tree")
+    parser.add_argument("--keep", action="store_true", default=False, help="Keep the generated tree")
+    arguments = parser.parse_args()
+    unknown = set(arguments.states.split(",")) - set(HEADER_STATES)
+    if unknown:
+        parser.error("unknown header states: " + ", ".join(sorted(unknown)))
+    try:
+        arguments.concurrency = [int(c) for c in arguments.concurrency.split(",") if c]
+    except ValueError:
+        parser.error("--concurrency must be comma separated numbers")
+    if any(c < 1 for c in arguments.concurrency):
+        parser.error("--concurrency must be positive numbers")
+
+    previous = None
+    if arguments.compare:
+        with io.open(arguments.compare, "r", encoding="utf8") as f:
+            previous = json.load(f)
+    if arguments.startup:
+        results = {"version": lh.__version__, "python": platform.python_version(), "platform": platform.platform(),
+                   "startup": measure_startup(arguments.startup)}
+        print_startup(results["startup"], previous and previous.get("startup"))
+    else:
+        results = run(arguments)
+        print_results(results, previous)
+    if arguments.output:
+        with io.open(arguments.output, "w", encoding="utf8") as f:
+            f.write(json.dumps(results, indent=2, sort_keys=True))
+
+
+if __name__ == "__main__":
+    main()
@@ -4,4 +4,23 @@ printf "Running tests...\nJavascript test\n\n"
 
 python ../licenseheaders.py -d "javascript" -t "mit" -y "2018" -o "David Smerkous" -n "Tests" -u "https://smerkous.com" -f 1
 
+printf "\nRuby test\n\n"
+
+## the header written before must be found again, so nothing is added to the file
+python ../licenseheaders.py -d "ruby" -t "mit" -y "2018" -o "David Smerkous" -n "Tests" -u "https://smerkous.com" -f 1
+python ../licenseheaders.py -d "ruby" -t "mit" -y "2018" -o "David Smerkous" -n "Tests" -u "https://smerkous.com" -f 1 --check || exit 1
+
+printf "\nErlang test\n\n"
+
+python ../licenseheaders.py -d "erlang" -t "mit" -y "2018" -o "David Smerkous" -n "Tests" -u "https://smerkous.com" -f 1
+python ../licenseheaders.py -d "erlang" -t "mit" -y "2018" -o "David Smerkous" -n "Tests" -u "https://smerkous.com" -f 1 --check || exit 1
+
+printf "\nDetection test\n\n"
+
+python test_detection.py || exit 1
+
+printf "\nGit test\n\n"
+
+python test_git.py || exit 1
+
 echo "Done!"
\ No newline at end of file
@@ -0,0 +1,256 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+
+"""Check that the compiled header detection finds the same headers as the original detection loop.
+
+scan_header() classifies the lines with the Detector of each type, compiled into a few combined
+expressions and literal tests. This compares it with baseline_scan_header(), an unchanged copy of the
+loop it replaced, which tries the patterns of the type one after the other with findall on each line, on
+random files of every type built from header, comment, code, shebang, empty and CRLF lines, and on a few
+files written out by hand. The one intended difference, for headers of line comments in types which also
+have block comments, is left out there and checked on its own.
+
+Example:
+    python test_detection.py
+"""
+
+from __future__ import unicode_literals
+from __future__ import print_function
+
+import os
+import io
+import re
+import sys
+import random
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+from licenseheaders import licenseheaders as lh
+from licenseheaders.licenseheaders import emptyPattern, licensePattern, yearsPattern
+
+## the elements of the scan_header dictionary which describe the header
+KEYS = ("skip", "headStart", "headEnd", "yearsLine", "haveLicense")
+
+## the lines the random files are made of
+PIECES = [
+    "#!/usr/bin/env x\n", "# -*- coding: utf-8 -*-\n", "\n", "   \n", "\t\n",
+    "/*\n", "/**\n", " * Copyright (c) 2010-2012 A\n", " * Copyright (©) 2010 Ä\n", " * license text\n",
+    " * Licensed under the MIT License\n", " */\n", "*/ license\n", "/* one */\n", "/* Copyright 2001 x */\n",
+    "// Copyright 2001-2002 x\n", "// hi\n", "  // license\n",
+    "# Copyright (C) 1999-2000\n", "# license\n", "## \n", "##\n", "#\n",
+    "-- Copyright 2010-2011\n", "-- x\n", "--\n",
+    "<?xml version=\"1.0\"?>\n", "<!DOCTYPE html>\n", "<!--\n", "  -->\n", "-->\n",
+    "' vb comment\n", "' Copyright 2005 vb\n", "=begin\n", "=end\n", "%% erl\n", "% Copyright 2003 m\n",
+    "\"\"\"\n", "{-\n", "-}\n", "(*\n", "*)\n", "REM license\n", ":: Copyright 2004\n",
+    "code();\n", "x = \"http://y\"\n", "int x; /* license */\n", "@echo off\n", "<?php\n", "?>\n",
+    "\r\n", "# Copyright (c) 2010-2012 A\r\n", "/*\r\n", " */\r\n", "// license\r\n", "code();\r\n",
+]
+
+## the first lines which files without an extension can be recognised by
+SHEBANGS = ["#!/bin/sh\n", "#!/usr/bin/env python\n", "#!/usr/bin/env ruby\r\n", "#!/usr/bin/perl -w\n"]
+
+## the settings of a type as the baseline loop takes them, with the patterns compiled
+def baseline_settings(language):
+    settings = {}
+    for key in ("keepFirst", "keepMore", "blockCommentStartPattern", "blockCommentEndPattern", "lineCommentStartPattern"):
+        pattern = getattr(language, key)
+        settings[key] = re.compile(pattern) if pattern else None
+    return settings
+
+## the header detection which the Detector replaced, copied unchanged from before it
+def baseline_scan_header(f, lines, settings):
+    skip = 0
+    headStart = None
+    headEnd = None
+    yearsLine = None
+    haveLicense = False
+    ## number of regular expression evaluations, for the statistics
+    evals = 0
+    ## now iterate throw the lines and try to determine the various indies
+    ## first try to find the start of the header: skip over shebang or empty lines
+    keepFirst = settings.get("keepFirst")
+    keepMore = settings.get("keepMore")
+    blockCommentStartPattern = settings.get("blockCommentStartPattern")
+    blockCommentEndPattern = settings.get("blockCommentEndPattern")
+    lineCommentStartPattern = settings.get("lineCommentStartPattern")
+    ## the patterns tried in turn on each line before the header, see below
+    if keepFirst:
+        firstPatterns = [keepFirst, emptyPattern]
+    else:
+        firstPatterns = [emptyPattern]
+    morePatterns = [keepMore, emptyPattern] if keepMore else [emptyPattern]
+    startPatterns = [p for p in (blockCommentStartPattern, lineCommentStartPattern) if p]
+    i = 0
+    for line in f:
+        line = line.decode('utf8')
+        lines.append(line)
+        ## the first line can be kept with keepFirst, further lines with keepMore
+        ## the first pattern that matches decides: keep, empty line (ignored), or the start of a comment
+        patterns = firstPatterns if i==0 else morePatterns
+        matched = None
+        for pattern in patterns + startPatterns:
+            evals = evals + 1
+            if pattern.findall(line):
+                matched = pattern
+                break
+        if matched is None:
+            ## we have reached something else, so no header in this file
+            #logging.debug("Did not find the start giving up at line %s, line is >%s<",i,line)
+            return {"skip":skip, "headStart":None, "headEnd":None, "yearsLine": None, "haveLicense": haveLicense, "regexEvals": evals}
+        if matched is emptyPattern:
+            pass
+        elif matched in startPatterns:
+            headStart = i
+            break
+        else:
+            skip = skip + 1
+        i = i+1
+    #logging.debug("Found preliminary start at %s",headStart)
+    ## now we have either reached the end, or we are at a line where a block start or line comment occurred
+    # if we have reached the end, return default dictionary without info
+    if headStart is None:
+        #logging.debug("We have reached the end, did not find anything really")
+        return {"skip":skip, "headStart":headStart, "headEnd":headEnd, "yearsLine": yearsLine, "haveLicense": haveLicense, "regexEvals": evals}
+    # otherwise process the comment block until it ends, reading more lines as we go
+    j = i
+    line = lines[i]
+    if blockCommentStartPattern:
+        while True:
+            #logging.debug("Checking line %s",j)
+            evals = evals + 1
+            if licensePattern.findall(line):
+                haveLicense = True
+            else:
+                evals = evals + 1
+                if blockCommentEndPattern.findall(line):
+                    return {"skip":skip, "headStart":headStart, "headEnd":j, "yearsLine": yearsLine, "haveLicense": haveLicense, "regexEvals": evals}
+                evals = evals + 1
+                if yearsPattern.findall(line):
+                    haveLicense = True
+                    yearsLine = j
+            line = f.readline()
+            if not line:
+                break
+            line = line.decode('utf8')
+            lines.append(line)
+            j = j+1
+        # if we went through all the lines without finding an end, maybe we have some syntax error or some other
+        # unusual situation, so lets return no header
+        #logging.debug("Did not find the end of a block comment, returning no header")
+        return {"skip":skip, "headStart":None, "headEnd":None, "yearsLine": None, "haveLicense": haveLicense, "regexEvals": evals}
+    else:
+        while True:
+            evals = evals + 1
+            if not lineCommentStartPattern.findall(line):
+                return {"skip":skip, "headStart":i, "headEnd":j-1, "yearsLine": yearsLine, "haveLicense": haveLicense, "regexEvals": evals}
+            evals = evals + 1
+            if licensePattern.findall(line):
+                haveLicense = True
+            else:
+                evals = evals + 1
+                if yearsPattern.findall(line):
+                    haveLicense = True
+                    yearsLine = j
+            line = f.readline()
+            if not line:
+                break
+            line = line.decode('utf8')
+            lines.append(line)
+            j = j+1
+        ## if we went through all the lines without finding the end of the block, it could be that the whole
+        ## file only consisted of the header, so lets return the last line index
+        return {"skip":skip, "headStart":i, "headEnd":j, "yearsLine": yearsLine, "haveLicense": haveLicense, "regexEvals": evals}
+
+## check if the header of a file starts with a line comment in a type which also has block comments: such a
+## header now ends with the line comments, where the baseline looked for the end of a block comment
+def starts_with_line_comment(language, lines, found):
+    if not language.blockCommentStartPattern or found["headStart"] is None:
+        return False
+    return not re.search(language.blockCommentStartPattern, lines[found["headStart"]].decode('utf8'))
+
+
+class DetectionTest(unittest.TestCase):
+
+    def assertSameDetection(self, content, language):
+        """Check that scan_header finds what the baseline found, except for the intended difference, see
+        test_line_comment_header_in_block_comment_type. Returns False if the difference applies."""
+        data = content.encode('utf8')
+        lines = []
+        found = lh.scan_header(io.BytesIO(data), lines, language.detector)
+        if starts_with_line_comment(language, lines, found):
+            return False
+        expectedLines = []
+        expected = baseline_scan_header(io.BytesIO(data), expectedLines, baseline_settings(language))
+        message = "{} {!r}".format(language.name, content)
+        self.assertEqual(dict((key, found[key]) for key in KEYS), dict((key, expected[key]) for key in KEYS), message)
+        self.assertEqual([line.decode('utf8') for line in lines], expectedLines, message)
+        return True
+
+    def test_random_files(self):
+        rnd = random.Random(12)
+        for language in lh.get_languages().languages:
+            compared = 0
+            for n in range(600):
+                content = "".join(rnd.choice(PIECES) for _ in range(rnd.randint(0, 12)))
+                if rnd.random() < 0.2:
+                    content = rnd.choice(SHEBANGS) + content
+                if rnd.random() < 0.3:
+                    content = content.rstrip("\n")
+                compared += self.assertSameDetection(content, language)
+            ## most files must still be compared, also for the types the difference applies to
+            self.assertGreater(compared, 300, language.name)
+
+    def test_headers(self):
+        for language in lh.get_languages().languages:
+            for content in [
+                "",
+                "code();\n",
+                "/*\n * Copyright (c) 2010 A\n * license\n */\ncode();\n",
+                "/*\r\n * Copyright (c) 2010 A\r\n * license\r\n */\r\ncode();\r\n",
+                "// Copyright 2010 A\n// license\ncode();\n/* later */\ncode();\n",
+                "#!/usr/bin/env ruby\n##\n## Copyright (c) 2010 A\n## license\n##\nputs 1\n",
+                "#!/bin/sh\r\n# Copyright (c) 2010 A\r\n# license\r\necho\r\n",
+                "=begin\nCopyright 2010 A\nlicense\n=end\nputs 1\n",
+                "<?xml version=\"1.0\"?>\n<!--\n  Copyright 2010 A\n  license\n-->\n<a/>\n",
+                "\n\n# Copyright (c) 2010 A\n# license",
+            ]:
+                self.assertSameDetection(content, language)
+
+    def test_line_comment_header_in_block_comment_type(self):
+        ## the intended difference: in a type with block comments, the baseline took a header starting with a
+        ## line comment up to the next end of a block comment (or found no header without one), so the ## header
+        ## written for ruby was never found again, and code up to a later */ was taken as part of a // header
+        cases = [
+            ("c", "// Copyright 2010 A\n// license\ncode();\n/* later */\ncode();\n", (0, 3), (0, 1)),
+            ("java", "// Copyright 2010 A\n// license\nclass A {}\n", (None, None), (0, 1)),
+            ("javascript", "\n// license\r\n// more\r\nf();\r\n/*\r\n */\r\n", (1, 5), (1, 2)),
+            ("ruby", "#!/usr/bin/env ruby\n##\n## Copyright (c) 2010 A\n## license\n##\nputs 1\n", (None, None), (1, 4)),
+            ("ruby", "# license\nputs 1\n=begin\n=end\n", (0, 3), (0, 0)),
+        ]
+        languages = lh.get_languages()
+        for name, content, before, now in cases:
+            language = languages.byName[name]
+            data = content.encode('utf8')
+            lines = []
+            found = lh.scan_header(io.BytesIO(data), lines, language.detector)
+            expected = baseline_scan_header(io.BytesIO(data), [], baseline_settings(language))
+            message = "{} {!r}".format(name, content)
+            self.assertTrue(starts_with_line_comment(language, lines, found), message)
+            self.assertEqual((expected["headStart"], expected["headEnd"]), before, message)
+            self.assertEqual((found["headStart"], found["headEnd"]), now, message)
+
+    def test_written_header_is_found_again(self):
+        ## the header written for a type must be detected as that header, or every run adds another one.
+        template = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "templates", "mit.tmpl")
+        settings = {"years": "2020", "owner": "A", "projectname": "P", "projecturl": "https://example.com"}
+        compiled = lh.CompiledTemplate(template, settings)
+        for language in lh.get_languages().languages:
+            header = compiled.header(language.name, "main", b"\n")
+            lines = []
+            found = lh.scan_header(io.BytesIO(header + b"code\n"), lines, language.detector)
+            self.assertEqual((found["headStart"], found["headEnd"]), (0, header.count(b"\n") - 1), language.name)
+            self.assertTrue(found["haveLicense"], language.name)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+
+"""Check the files git_files() takes from git for --since and --staged, on a repository made for the test.
+
+Example:
+    python test_git.py
+"""
+
+from __future__ import unicode_literals
+from __future__ import print_function
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import subprocess
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+from licenseheaders import licenseheaders as lh
+
+
+@unittest.skipUnless(shutil.which("git"), "git is not installed")
+class GitFilesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.git("init", "-q")
+        self.write("old.py", "x = 1\n")
+        self.git("add", "old.py")
+        self.git("-c", "user.name=Test", "-c", "user.email=test@example.com", "commit", "-q", "-m", "first")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def git(self, *args):
+        subprocess.check_call(["git", "-C", self.dir] + list(args))
+
+    def write(self, name, content):
+        with open(os.path.join(self.dir, name), "w") as f:
+            f.write(content)
+
+    def test_since(self):
+        self.write("old.py", "x = 2\n")
+        self.write("new.py", "y = 1\n")
+        self.write("notes.txt", "z\n")
+        files = sorted(lh.git_files(self.dir, "HEAD"))
+        self.assertEqual(files, [os.path.join(self.dir, "new.py"), os.path.join(self.dir, "old.py")])
+
+    def test_staged(self):
+        self.write("old.py", "x = 2\n")
+        self.write("new.py", "y = 1\n")
+        self.git("add", "new.py")
+        self.assertEqual(list(lh.git_files(self.dir, staged=True)), [os.path.join(self.dir, "new.py")])
+
+    def test_since_is_not_an_option(self):
+        ## a ref starting with - would be taken as an option of git diff, here one which writes a file
+        output = os.path.join(self.dir, "output")
+        with self.assertRaises(ValueError):
+            list(lh.git_files(self.dir, "--output=" + output))
+        self.assertFalse(os.path.exists(output))
+
+    def test_since_is_a_commit(self):
+        with self.assertRaises(ValueError):
+            list(lh.git_files(self.dir, "no-such-ref"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -20,10 +20,12 @@ setup(
     url="http://github.com/mchoji/licenseheaders",
     #py_modules=['licenseheaders'],
     packages=find_packages(),
-    package_data={'': ['templates/*']},
+    package_data={'': ['templates/*', 'languages.json']},
     include_package_data=True,
     entry_points={'console_scripts': ['licenseheaders=licenseheaders.licenseheaders:main']},
     long_description=readme,
+    # os.scandir is new in 3.5, and os.replace and asyncio are used too
+    python_requires=">=3.5",
     # test_suite='tests',
     setup_requires=[],
     # tests_require=['mock'],
@@ -31,11 +33,15 @@ setup(
                  "License :: OSI Approved :: MIT License",
                  "Environment :: Console",
                  "Natural Language :: English",
-                 "Programming Language :: Python :: 2.7",
-                 "Programming Language :: Python :: 3.3",
-                 "Programming Language :: Python :: 3.4",
+                 "Programming Language :: Python :: 3",
+                 "Programming Language :: Python :: 3 :: Only",
                  "Programming Language :: Python :: 3.5",
+                 "Programming Language :: Python :: 3.6",
                  "Programming Language :: Python :: 3.7",
+                 "Programming Language :: Python :: 3.8",
+                 "Programming Language :: Python :: 3.9",
+                 "Programming Language :: Python :: 3.10",
+                 "Programming Language :: Python :: 3.11",
                  "Topic :: Software Development",
                  "Topic :: Software Development :: Code Generators",
                  "Intended Audience :: Developers",